@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Compare the memory used and the lookup time of the permits held as a plain
+dict of dates and as a PermitTable.
+
+Usage: PYTHONPATH=. python3 benchmarks/bench_permit_table.py [sizes...]
+"""
+
+import sys
+import timeit
+import tracemalloc
+from datetime import date
+
+from hoa_bot import PermitTable
+
+
+def gen_permits(n_permits):
+    """One date object per permit, as produced by the YAML parser"""
+    today = date.today().toordinal()
+    return [
+        ('User{}'.format(i) if i % 3 == 0 else 'user{}'.format(i),
+         date.fromordinal(today - i % 180))
+        for i in range(n_permits)
+    ]
+
+
+def measure(build, n_permits):
+    tracemalloc.start()
+    table = build(gen_permits(n_permits))
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    users = ['user{}'.format(i) for i in range(0, n_permits, 10)]
+    lookup = min(timeit.repeat(
+        lambda: [user in table for user in users], number=1, repeat=3
+    ))
+    return size, lookup / len(users)
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 10000, 100000]
+    builders = [('dict', dict), ('table', PermitTable)]
+    print("{:>8} {:>6} {:>12} {:>14}".format('permits', 'type',
+                                             'memory (kB)', 'lookup (ns)'))
+    for n in sizes:
+        for name, build in builders:
+            size, lookup = measure(build, n)
+            print("{:>8} {:>6} {:>12.0f} {:>14.0f}".format(
+                n, name, size / 1024, lookup * 1e9
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Time full runs of the bot against a fake Reddit seeded with the given number
+of permits, contributors, modmail conversations and new submissions, and
+report the time, requests and items of each phase along with the number of
+calls to each endpoint.
+
+The first run does the initial work (expiring permits, granting the pending
+ones), the following ones show the steady state.
+
+Usage: PYTHONPATH=. python3 benchmarks/bench_run.py [--permits N] ...
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fake_reddit import FakeReddit, seed  # noqa: E402
+from hoa_bot import (  # noqa: E402
+    SUBREDDIT, BotState, Outbox, RunMetrics, WallBot,
+)
+
+
+class TableMetrics(RunMetrics):
+    """Prints the metrics of each run as a table instead of logging them"""
+
+    def report(self):
+        print("{:<24} {:>9} {:>9} {:>11} {:>7}".format(
+            'phase', 'time (s)', 'requests', 'bytes', 'items'
+        ))
+        for (_, name), stats in self.phases.items():
+            print("{:<24} {:>9.3f} {:>9} {:>11} {:>7}".format(
+                name, stats['seconds'], stats['requests'], stats['bytes'],
+                stats['items'],
+            ))
+        print("{:<24} {:>9} {:>9} {:>11}".format(
+            'total', '', self.requests, self.bytes
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--permits', type=int, default=1000)
+    parser.add_argument('--contributors', type=int, default=1000)
+    parser.add_argument('--conversations', type=int, default=25)
+    parser.add_argument('--posts', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds per request")
+    parser.add_argument('--runs', type=int, default=2)
+    args = parser.parse_args()
+
+    metrics = TableMetrics()
+    reddit = FakeReddit(metrics, latency=args.latency,
+                        ratelimit=sys.maxsize)
+    seed(reddit, SUBREDDIT, permits=args.permits,
+         contributors=args.contributors, conversations=args.conversations,
+         posts=args.posts)
+    with tempfile.TemporaryDirectory() as tmp:
+        # Not the wiki cache of a deployment in the current directory
+        config = {'bot': {'wiki_cache': os.path.join(tmp, 'wiki.json')}}
+        bot = WallBot(config, reddit=reddit, state=BotState(),
+                      outbox=Outbox(), metrics=metrics)
+
+        for i in range(args.runs):
+            print("\nRun {}".format(i + 1))
+            calls = reddit.calls.copy()
+            bot.run()
+            print("calls: " + ", ".join(
+                "{} {}".format(endpoint, count)
+                for endpoint, count in sorted((reddit.calls - calls).items())
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Compare the time taken to parse and dump the allowlist wiki page with the
+pure Python PyYAML codec and with the one used by the bot.
+
+Usage: PYTHONPATH=. python3 benchmarks/bench_serializer.py [sizes...]
+"""
+
+import sys
+import timeit
+from datetime import date, timedelta
+
+import yaml
+
+from hoa_bot import WikiAllowlist, YamlSerializer
+
+
+class PureSerializer(YamlSerializer):
+    Loader = yaml.SafeLoader
+    Dumper = yaml.SafeDumper
+
+
+def gen_document(n_permits):
+    today = date.today()
+    return {
+        WikiAllowlist.PERMIT_KEY: {
+            'user{}'.format(i): today - timedelta(days=i % 180)
+            for i in range(n_permits)
+        },
+        WikiAllowlist.PERMALLOWED_KEY: ['danny', 'gorby'],
+    }
+
+
+def bench(serializer, document, repeat=3):
+    text = serializer.dump(document)
+    load = min(timeit.repeat(lambda: serializer.load(text),
+                             number=1, repeat=repeat))
+    dump = min(timeit.repeat(lambda: serializer.dump(document),
+                             number=1, repeat=repeat))
+    return load, dump
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 10000, 100000]
+    serializers = [('pure', PureSerializer()), ('bot', YamlSerializer())]
+    serializers[1][1].load('')  # picks the codec
+    print("bot codec: {}".format(YamlSerializer.Loader.__name__))
+    print("{:>8} {:>6} {:>10} {:>10}".format('permits', 'codec',
+                                             'load (s)', 'dump (s)'))
+    for n in sizes:
+        document = gen_document(n)
+        for name, serializer in serializers:
+            load, dump = bench(serializer, document)
+            print("{:>8} {:>6} {:>10.3f} {:>10.3f}".format(n, name,
+                                                           load, dump))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Measure the cost of starting the bot: the time to import it, as it is and
+with praw and yaml imported eagerly as they used to be, and what Python's
+-X importtime attributes to each of them.
+
+Usage: PYTHONPATH=. python3 benchmarks/bench_startup.py [runs]
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+
+SNIPPETS = [
+    ('lazy', 'import hoa_bot'),
+    ('eager', 'import praw, yaml, hoa_bot'),
+]
+
+
+def wall_time(code, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def import_times(code):
+    """Cumulative import time of the top level modules, in ms"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            check=True, capture_output=True, text=True)
+    times = {}
+    for line in result.stderr.splitlines()[1:]:
+        _, cumulative, module = line.split('|')
+        if not module.startswith('  '):
+            times[module.strip()] = int(cumulative) / 1000
+    return times
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    baseline = wall_time('pass', runs)
+    print("interpreter startup: {:.1f} ms".format(baseline * 1000))
+    for name, code in SNIPPETS:
+        print("{:>6}: {:.1f} ms".format(
+            name, (wall_time(code, runs) - baseline) * 1000
+        ))
+        times = import_times(code)
+        for module in ('hoa_bot', 'praw', 'yaml'):
+            if module in times:
+                print("        {:<8} {:.1f} ms".format(module, times[module]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+"""
+In-process stand-in for the parts of the Reddit API used by the bot, to
+measure how a run scales without touching Reddit.
+
+Methods take their arguments as praw's do, keyword-only where praw's are,
+so that calls praw would reject fail here too. Every call that would make
+a request sleeps for ``latency`` seconds, is counted by endpoint, and
+reports a rough estimate of the response size to the RunMetrics of the
+bot, as CountingRequestor does. Listings are paged like Reddit's, one
+request per PAGE_SIZE items.
+"""
+
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+
+import yaml
+
+from hoa_bot import PERMIT_LENGTH, RI_FLAIR, WIKI_PAGE, WikiAllowlist
+
+PAGE_SIZE = 100
+# Rough size of a listing item or of a small response, as sent by Reddit
+ITEM_BYTES = 1000
+
+
+class FakeReddit:
+    def __init__(self, metrics, latency=0.0, ratelimit=1000):
+        self.metrics = metrics
+        self.latency = latency
+        self.ratelimit = ratelimit
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.auth = SimpleNamespace(limits={})
+        self.subreddits = {}
+        self.submissions = {}
+
+    def request(self, endpoint, items=1):
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls[endpoint] += 1
+            used = sum(self.calls.values())
+            self.auth.limits = {
+                'remaining': max(0, self.ratelimit - used),
+                'used': used,
+            }
+        self.metrics.record(max(1, items) * ITEM_BYTES)
+
+    def paginate(self, endpoint, items, limit=None):
+        items = list(items)[:limit]
+        for start in range(0, max(1, len(items)), PAGE_SIZE):
+            page = items[start:start + PAGE_SIZE]
+            self.request(endpoint, len(page))
+            yield from page
+
+    def subreddit(self, name):
+        if name.lower() not in self.subreddits:
+            self.subreddits[name.lower()] = FakeSubreddit(self, name)
+        return self.subreddits[name.lower()]
+
+    def redditor(self, name):
+        return FakeRedditor(self, name)
+
+    def info(self, *, fullnames):
+        return self.paginate(
+            'info', [self.submissions[f] for f in fullnames
+                     if f in self.submissions],
+        )
+
+
+class FakeRedditor:
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+    def message(self, *, subject, message, from_subreddit=None):
+        self.reddit.request('message')
+
+
+class FakeSubreddit:
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.display_name = name
+        self.pages = {}
+        self.wiki = {}
+        self.submissions = []
+        self.moderators = []
+        self.conversations = []
+        self.contributor = FakeContributors(reddit)
+        self.modmail = FakeModmail(self)
+
+    def __str__(self):
+        return self.display_name
+
+    def new(self, *, limit=100):
+        return self.reddit.paginate('new', self.submissions, limit)
+
+    def moderator(self):
+        self.reddit.request('moderator', len(self.moderators))
+        return [FakeRedditor(self.reddit, m) for m in self.moderators]
+
+
+class FakeModmail:
+    def __init__(self, subreddit):
+        self.subreddit = subreddit
+
+    def __call__(self, id):
+        """Conversation by id, lazy so without any request"""
+        return next(conversation
+                    for conversation in self.subreddit.conversations
+                    if conversation.id == id)
+
+    def conversations(self, *, limit=25):
+        return self.subreddit.reddit.paginate(
+            'modmail', self.subreddit.conversations, limit
+        )
+
+
+class FakeContributors:
+    def __init__(self, reddit):
+        self.reddit = reddit
+        self.names = {}  # Ordered like the listing
+
+    def __call__(self, redditor=None, *, limit=100):
+        if redditor is not None:
+            names = [n for n in self.names if n.lower() == redditor.lower()]
+        else:
+            names = list(self.names)
+        return self.reddit.paginate(
+            'contributor', [FakeRedditor(self.reddit, n) for n in names],
+            limit,
+        )
+
+    def add(self, user):
+        self.reddit.request('contributor_add')
+        self.names[str(user)] = None
+
+    def remove(self, user):
+        self.reddit.request('contributor_remove')
+        del self.names[str(user)]
+
+
+class FakeWikiPage:
+    """Wiki page, fetched on first access like praw's lazy objects"""
+
+    def __init__(self, reddit, page):
+        self.reddit = reddit
+        self.page = page
+        self.fetched = False
+
+    def _fetch(self):
+        if not self.fetched:
+            self.reddit.request('wiki', len(self.page['content_md']) // 100)
+            self.fetched = True
+
+    @property
+    def content_md(self):
+        self._fetch()
+        return self.page['content_md']
+
+    @property
+    def revision_id(self):
+        self._fetch()
+        return self.page['revision_id']
+
+    def revisions(self, *, limit=None):
+        self.reddit.request('wiki_revisions')
+        return iter([{'id': self.page['revision_id'],
+                      'reason': self.page.get('reason')}])
+
+    def edit(self, *, content, previous=None, reason=None):
+        self.reddit.request('wiki_edit')
+        self.page['content_md'] = content
+        self.page['reason'] = reason
+        self.page['revision_id'] = 'rev{}'.format(
+            self.reddit.calls['wiki_edit']
+        )
+
+
+class FakeWiki:
+    def __init__(self, reddit, pages):
+        self.reddit = reddit
+        self.pages = pages
+
+    def __getitem__(self, name):
+        return FakeWikiPage(self.reddit, self.pages[name])
+
+
+class FakeConversation:
+    def __init__(self, reddit, id, subject, participant, messages):
+        self.reddit = reddit
+        self.id = id
+        self.subject = subject
+        self.participant = participant
+        self.messages = messages
+        self.last_updated = max(
+            (message.date for message in messages), default='2021-05-01'
+        )
+
+    def reply(self, *, author_hidden=False, body, internal=False):
+        self.reddit.request('modmail_reply')
+
+    def archive(self):
+        self.reddit.request('modmail_archive')
+
+
+def seed(reddit, name, permits=1000, contributors=1000, conversations=25,
+         posts=100, permallowed=10, moderators=10):
+    """
+    Fill a subreddit with ``permits`` permits spread over a little more than
+    their length, so that some have expired, ``contributors`` approved users
+    (the first permit holders), ``conversations`` modmail conversations (one
+    in five an approved user notification, the others an !allow command) and
+    ``posts`` new submissions (one in ten a sufficient RI).
+    """
+    subreddit = reddit.subreddit(name)
+    today = date.today()
+    now = time.time()
+
+    document = {
+        WikiAllowlist.PERMIT_KEY: {
+            'user{}'.format(i): today - timedelta(i % (PERMIT_LENGTH + 30))
+            for i in range(permits)
+        },
+        WikiAllowlist.PERMALLOWED_KEY: [
+            'regular{}'.format(i) for i in range(permallowed)
+        ],
+    }
+    subreddit.pages[WIKI_PAGE] = {
+        'content_md': yaml.safe_dump(document),
+        'revision_id': 'rev0',
+    }
+    subreddit.wiki = FakeWiki(reddit, subreddit.pages)
+
+    subreddit.contributor.names = dict.fromkeys(
+        'user{}'.format(i) for i in range(contributors)
+    )
+    subreddit.moderators = ['mod{}'.format(i) for i in range(moderators)]
+
+    subreddit.conversations = []
+    for i in range(conversations):
+        if i % 5 == 0:
+            conversation = FakeConversation(
+                reddit, 'conv{}'.format(i), 'you are an approved user',
+                'newuser{}'.format(i), [],
+            )
+        else:
+            conversation = FakeConversation(
+                reddit, 'conv{}'.format(i), 'May I post?',
+                'asker{}'.format(i),
+                [SimpleNamespace(
+                    id='conv{}_0'.format(i),
+                    author=subreddit.moderators[i % moderators],
+                    body_markdown='!allow',
+                    date=datetime.now().isoformat(),
+                )],
+            )
+        subreddit.conversations.append(conversation)
+
+    subreddit.submissions = []
+    for i in range(posts):
+        submission = SimpleNamespace(
+            fullname='t3_{}{}'.format(name, i),
+            author='poster{}'.format(i),
+            subreddit=name,
+            created_utc=now - i * 60,
+            link_flair_text=RI_FLAIR if i % 10 == 0 else 'Discussion',
+            score=i,
+        )
+        subreddit.submissions.append(submission)
+        reddit.submissions[submission.fullname] = submission
+    return subreddit
@@ -1,13 +1,48 @@
 #!/usr/bin/env python3
+"""Maintain the list of zoning permits of /r/badeconomics"""
 
+import argparse
+from collections.abc import MutableMapping
 import configparser
+from contextlib import contextmanager
 from datetime import date, datetime, timedelta
-import copy
-import praw
-import yaml
+import difflib
+from functools import partial
+import heapq
+import importlib.util
+import itertools
+import json
+import math
+import os
+import sqlite3
+import sys
+import threading
+import time
 import logging
 
+SUBREDDIT = 'badeconomics'
+USER_AGENT = 'BadEconomics Zoning Bot'
+WIKI_PAGE = 'zoning_whitelist'
+RI_FLAIR = 'Sufficient'
 PERMIT_LENGTH = 180
+COMMIT_ATTEMPTS = 3
+MODERATOR_TTL = 3600
+RI_PENDING_DAYS = 14
+MODMAIL_SEEN_LIMIT = 1000
+SWEEP_INTERVAL = 3600
+ACTION_WORKERS = 4
+# Reads made at once by WallBot.prefetch
+PREFETCH_WORKERS = 5
+REQUEST_RESERVE = 10
+ACTION_RETRIES = 3
+POLL_INTERVAL = 10
+STATE_FILE = 'hoa_bot_state.json'
+WIKI_CACHE = 'hoa_bot_wiki.json'
+OUTBOX_FILE = 'hoa_bot_outbox.sqlite'
+TOKEN_FILE = 'hoa_bot_token.json'
+TOKEN_MARGIN = 60
+OUTBOX_ATTEMPTS = 5
+PROBE_TIMEOUT = 10
 
 PM_EXPIRE_SUBJECT = "Your time has expired"
 PM_EXPIRE_TEXT = """The Honorable {user},
@@ -52,45 +87,468 @@ https://www.reddit.com/message/compose?to=%2Fr%2Fbadeconomics
 """
 
 
+def lazy_import(name):
+    """
+    Module only imported on first attribute access, so that a oneshot run
+    with nothing to do does not pay for importing praw and yaml.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+praw = lazy_import('praw')
+prawcore = lazy_import('prawcore')
+yaml = lazy_import('yaml')
+
+
+def config_option(config, section, option, default=None):
+    """Read an optional setting, from a ConfigParser or a plain dict"""
+    try:
+        return config[section][option]
+    except KeyError:
+        return default
+
+
+def subreddit_option(config, subreddit, option, default=None):
+    """Setting of one subreddit, falling back to the [bot] section"""
+    return config_option(
+        config,
+        'subreddit:' + subreddit,
+        option,
+        config_option(config, 'bot', option, default),
+    )
+
+
+def subreddit_path(config, subreddit, option, default=None):
+    """
+    File path setting of one subreddit, with ``{subreddit}`` replaced by its
+    name. A path shared through the [bot] section by several subreddits
+    gets the name added before its extension, so that none of them
+    overwrites the file of another.
+    """
+    path = subreddit_option(config, subreddit, option, default)
+    if not path:
+        return path
+    if '{subreddit}' in path:
+        return path.format(subreddit=subreddit)
+    own = config_option(config, 'subreddit:' + subreddit, option)
+    if own is None and len(subreddit_names(config)) > 1:
+        root, ext = os.path.splitext(path)
+        return '{}_{}{}'.format(root, subreddit, ext)
+    return path
+
+
+def subreddit_names(config):
+    """Subreddits with a section in the configuration, or /r/badeconomics"""
+    return [section.split(':', 1)[1] for section in config
+            if section.startswith('subreddit:')] or [SUBREDDIT]
+
+
+def ri_subreddits(config, subreddit):
+    """Subreddits whose RIs earn a permit in ``subreddit``"""
+    names = subreddit_option(config, subreddit, 'ri_subreddits') or subreddit
+    return [name.strip() for name in names.split(',') if name.strip()]
+
+
+def atomic_write(path, text, mode=None):
+    """
+    Write text to a temporary file renamed over path, so that neither a
+    crash nor a concurrent reader ever sees a truncated file. ``mode`` sets
+    the permissions of the file, subject to the umask when not given.
+    """
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                 0o666 if mode is None else mode)
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class BotState:
+    """
+    Small JSON document persisted between runs, holding the caches that
+    would otherwise be refetched from Reddit every time the oneshot runs.
+    Without a path, the state only lives in memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.data = {}
+        self.root = None
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.data = json.load(f)
+            except ValueError:
+                logging.warning("Ignoring corrupted state file %s", path)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def scope(self, name):
+        """State of one of several subreddits, saved along with this one"""
+        scoped = BotState()
+        scoped.data = self.data.setdefault(name, {})
+        scoped.root = self
+        return scoped
+
+    def save(self):
+        if self.root is not None:
+            return self.root.save()
+        if self.path is None:
+            return
+        atomic_write(self.path, json.dumps(self.data))
+
+
+def normalize_username(user) -> str:
+    """Canonical form of a username, Reddit usernames being case-insensitive"""
+    return str(user).lower()
+
+
+class PermitTable(MutableMapping):
+    """
+    Permits of the allowlist, as a mapping of username to start date looked
+    up case-insensitively.
+
+    Permits are granted on a few hundred distinct days at most, so the date
+    objects are shared between permits, and the username is only stored a
+    second time when it is not lowercase, to keep large allowlists small in
+    memory.
+    """
+
+    __slots__ = ('_starts', '_names', '_dates')
+
+    def __init__(self, permits=()):
+        self._starts = {}  # Normalized username -> start date
+        self._names = {}  # Normalized username -> username, if different
+        self._dates = {}  # Shared date objects
+        self.update(permits)
+
+    @classmethod
+    def from_ordinals(cls, users, ordinals):
+        table = cls()
+        dates = {o: date.fromordinal(o) for o in set(ordinals)}
+        for user, ordinal in zip(users, ordinals):
+            table[user] = dates[ordinal]
+        return table
+
+    def __getitem__(self, user):
+        return self._starts[normalize_username(user)]
+
+    def __setitem__(self, user, start_date):
+        key = normalize_username(user)
+        if key not in self._starts and key != user:
+            self._names[key] = user
+        self._starts[key] = self._dates.setdefault(start_date, start_date)
+
+    def __delitem__(self, user):
+        key = normalize_username(user)
+        del self._starts[key]
+        self._names.pop(key, None)
+
+    def __contains__(self, user):
+        return normalize_username(user) in self._starts
+
+    def __iter__(self):
+        return (self._names.get(key, key) for key in self._starts)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def items(self):
+        return [
+            (self._names.get(key, key), start_date)
+            for key, start_date in self._starts.items()
+        ]
+
+    def ordinals(self):
+        """Start dates as ordinals, in iteration order"""
+        return [start_date.toordinal() for start_date in self._starts.values()]
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self.items()))
+
+
+class UserSet:
+    """Immutable set of usernames, with case-insensitive membership tests"""
+
+    __slots__ = ('_names', '_keys')
+
+    def __init__(self, names=()):
+        self._names = tuple(names)
+        self._keys = frozenset(normalize_username(n) for n in self._names)
+
+    def __contains__(self, user):
+        return normalize_username(user) in self._keys
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, list(self._names))
+
+
+def alias_free_dumper():
+    """The libyaml safe dumper when available, never writing aliases"""
+
+    class Dumper(getattr(yaml, 'CSafeDumper', yaml.SafeDumper)):
+        def ignore_aliases(self, data):
+            # Permits of the same day share their date object (see
+            # PermitTable), which must not turn into anchors and aliases
+            return True
+
+    return Dumper
+
+
+class YamlSerializer:
+    """
+    Codec of the allowlist wiki page, using the libyaml bindings when PyYAML
+    was built with them, which are much faster on large allowlists.
+    """
+
+    # Picked on first use, yaml being imported lazily
+    Loader = None
+    Dumper = None
+
+    def load(self, text):
+        if self.Loader is None:
+            YamlSerializer.Loader = getattr(yaml, 'CSafeLoader',
+                                            yaml.SafeLoader)
+        return yaml.load(text, Loader=self.Loader)
+
+    def dump(self, document):
+        if self.Dumper is None:
+            YamlSerializer.Dumper = alias_free_dumper()
+        # One sorted "user: date" line per permit keeps wiki diffs readable
+        return yaml.dump(
+            document,
+            Dumper=self.Dumper,
+            default_flow_style=False,
+            sort_keys=True,
+            allow_unicode=True,
+        )
+
+
+def expiry_ordinal(start_date: date, permit_length=PERMIT_LENGTH) -> int:
+    """Ordinal of the last day of validity of a permit"""
+    return (start_date + timedelta(permit_length)).toordinal()
+
+
+class ExpiryIndex:
+    """
+    Priority queue of permit expiry dates.
+
+    Entries are not removed when a permit is renewed or deleted: they are
+    checked against the permits when they reach the top of the queue, and
+    dropped if they are stale.
+    """
+
+    def __init__(self, permits, permit_length=PERMIT_LENGTH):
+        self.permits = permits
+        self.permit_length = permit_length
+        self.heap = [
+            (self.deadline(start_date), user)
+            for user, start_date in permits.items()
+        ]
+        heapq.heapify(self.heap)
+
+    def deadline(self, start_date: date) -> int:
+        return expiry_ordinal(start_date, self.permit_length)
+
+    def push(self, user: str, start_date: date):
+        heapq.heappush(self.heap, (self.deadline(start_date), user))
+
+    def _is_stale(self, entry):
+        deadline, user = entry
+        return (user not in self.permits
+                or self.deadline(self.permits[user]) != deadline)
+
+    def next_expiry(self):
+        """Last day of validity of the first permit to expire, if any"""
+        while self.heap and self._is_stale(self.heap[0]):
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return date.fromordinal(self.heap[0][0])
+
+    def pop_expired(self, today: date):
+        """Remove and return the users whose permit expired before today"""
+        expired = []
+        while self.heap and self.heap[0][0] < today.toordinal():
+            entry = heapq.heappop(self.heap)
+            if not self._is_stale(entry):
+                expired.append(entry[1])
+        return expired
+
+
 class WikiAllowlist:
     PERMIT_KEY = 'contributors'
     PERMALLOWED_KEY = 'whitelist'
+    # Tells the revisions made by commit apart from those of moderators
+    EDIT_REASON = 'Permits updated by the bot'
+    serializer = YamlSerializer()
 
-    def __init__(self, subreddit):
+    def __init__(self, subreddit, cache_path=None, page=WIKI_PAGE,
+                 permit_length=PERMIT_LENGTH):
         self.subreddit = subreddit
+        self.cache_path = cache_path
+        self.page = page
+        self.permit_length = permit_length
         self.allowlist = None
+        self.revision_id = None
         self.to_update = {}
         self.to_delete = []
 
         self.reload()
 
     def reload(self):
-        wiki_page = self.subreddit.wiki['zoning_whitelist']
-        self.allowlist = yaml.safe_load(wiki_page.content_md)
+        wiki_page = self.subreddit.wiki[self.page]
+        if not self._load_cache(wiki_page):
+            self.allowlist = self.serializer.load(wiki_page.content_md)
+            self.allowlist[self.PERMIT_KEY] = PermitTable(
+                self.allowlist[self.PERMIT_KEY]
+            )
+            self.revision_id = wiki_page.revision_id
+            self._save_cache()
+        self._permallowed = UserSet(self.allowlist[self.PERMALLOWED_KEY])
+        self.expiries = ExpiryIndex(self.permits(), self.permit_length)
+
+    def _load_cache(self, wiki_page):
+        """
+        Load the allowlist from the local cache if it holds the latest
+        revision of the page, which only costs fetching the last revision id.
+        """
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return False
+        latest = next(iter(wiki_page.revisions(limit=1)), None)
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except ValueError:
+            return False
+        if latest is None or latest['id'] != cache['revision_id']:
+            return False
+
+        self.allowlist = cache['allowlist']
+        self.allowlist[self.PERMIT_KEY] = PermitTable.from_ordinals(
+            cache['permit_users'], cache['permit_dates'],
+        )
+        self.revision_id = cache['revision_id']
+        return True
+
+    def _save_cache(self):
+        if self.cache_path is None:
+            return
+        allowlist = dict(self.allowlist)
+        permits = allowlist.pop(self.PERMIT_KEY)
+        try:
+            cache = json.dumps({
+                'revision_id': self.revision_id,
+                'allowlist': allowlist,
+                'permit_users': list(permits),
+                'permit_dates': permits.ordinals(),
+            })
+        except TypeError:  # not representable in JSON, don't cache
+            return
+        atomic_write(self.cache_path, cache)
+
+    def _drop_cache(self):
+        if self.cache_path is not None and os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
 
     def commit(self):
-        """Commit the pending changes to the allowlist"""
-        # Reload to avoid race conditions between edits
-        self.reload()
+        """
+        Commit the pending changes to the allowlist.
 
-        allowlist_new = copy.deepcopy(self.allowlist)
-        allowlist_new[self.PERMIT_KEY].update(self.to_update)
-        for u in self.to_delete:
-            allowlist_new[self.PERMIT_KEY].pop(u)
-        if self.allowlist != allowlist_new:
-            wiki_page = self.subreddit.wiki['zoning_whitelist']
-            wiki_page.edit(yaml.safe_dump(allowlist_new))
+        The edit is made against the revision the allowlist was loaded from.
+        If someone edited the page in the meantime, Reddit rejects it, and the
+        pending changes are applied again on top of the latest revision.
+        """
+        if not self.to_update and not self.to_delete:
+            return
 
-        self.reload()
+        for _ in range(COMMIT_ATTEMPTS):
+            # The revision is unknown after a conflict or a previous commit
+            if self.revision_id is None:
+                self.reload()
+                if not self._apply_pending():
+                    break
+
+            wiki_page = self.subreddit.wiki[self.page]
+            try:
+                wiki_page.edit(
+                    content=self.serializer.dump(self.document()),
+                    previous=self.revision_id,
+                    reason=self.EDIT_REASON,
+                )
+            except prawcore.exceptions.Conflict:
+                logging.info("The allowlist was edited concurrently, retrying")
+                self.revision_id = None
+            else:
+                self.revision_id = self._own_revision(wiki_page)
+                if self.revision_id is None:
+                    self._drop_cache()
+                else:
+                    self._save_cache()
+                break
+        else:
+            raise RuntimeError(
+                "Could not commit the allowlist after {} attempts"
+                .format(COMMIT_ATTEMPTS)
+            )
+
+        self.to_update = {}
+        self.to_delete = []
+
+    def _own_revision(self, wiki_page):
+        """
+        Id of the revision just made by commit, which the edit does not
+        return, or None if the page was edited again since.
+        """
+        latest = next(iter(wiki_page.revisions(limit=1)), None)
+        if latest is None or latest.get('reason') != self.EDIT_REASON:
+            return None
+        return latest['id']
+
+    def _apply_pending(self):
+        """Apply the pending changes to a freshly loaded allowlist"""
+        changed = False
+        for user, start_date in self.to_update.items():
+            if self.permits().get(user) != start_date:
+                self.permits()[user] = start_date
+                self.expiries.push(user, start_date)
+                changed = True
+        for user in self.to_delete:
+            if user in self.permits():
+                del self.permits()[user]
+                changed = True
+        return changed
 
     def update(self, user: str, start_date: date):
         if (
-            (date.today() - start_date).days <= PERMIT_LENGTH
+            (date.today() - start_date).days <= self.permit_length
             and (user not in self.permits()
                  or self.permits()[user] < start_date)
         ):
             self.to_update[user] = start_date
-            self.permits().update(self.to_update)
+            self.permits()[user] = start_date
+            self.expiries.push(user, start_date)
             return True
         else:
             return False
@@ -102,60 +560,1291 @@ class WikiAllowlist:
     def permits(self):
         return self.allowlist[self.PERMIT_KEY]
 
+    def document(self):
+        """The allowlist, as written to the wiki page"""
+        document = dict(self.allowlist)
+        document[self.PERMIT_KEY] = dict(self.permits().items())
+        return document
+
+    def expired(self):
+        """Users whose permit has expired, oldest first"""
+        return self.expiries.pop_expired(date.today())
+
+    def next_expiry(self):
+        return self.expiries.next_expiry()
+
     def permallowed(self):
-        return self.allowlist[self.PERMALLOWED_KEY]
+        return self._permallowed
 
     def __getitem__(self, user: str):
         return self.permits()[user]
 
 
+class SqlitePermits(MutableMapping):
+    """Permits table of a SqliteAllowlist, as a user -> start date mapping"""
+
+    def __init__(self, db, permit_length=PERMIT_LENGTH):
+        self.db = db
+        self.permit_length = permit_length
+
+    def __getitem__(self, user):
+        row = self.db.execute(
+            "SELECT start_date FROM permits WHERE user = ?", (user,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(user)
+        return date.fromordinal(row[0])
+
+    def __setitem__(self, user, start_date):
+        self.db.execute(
+            "INSERT OR REPLACE INTO permits (user, start_date, expires) "
+            "VALUES (?, ?, ?)",
+            (user, start_date.toordinal(),
+             expiry_ordinal(start_date, self.permit_length)),
+        )
+
+    def __delitem__(self, user):
+        if self.db.execute(
+            "DELETE FROM permits WHERE user = ?", (user,)
+        ).rowcount == 0:
+            raise KeyError(user)
+
+    def __iter__(self):
+        return iter([row[0] for row in self.db.execute(
+            "SELECT user FROM permits"
+        )])
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM permits").fetchone()[0]
+
+    def items(self):
+        return [
+            (user, date.fromordinal(start_date))
+            for user, start_date in self.db.execute(
+                "SELECT user, start_date FROM permits"
+            )
+        ]
+
+
+class SqliteExpiryIndex:
+    """ExpiryIndex counterpart answered by the expiry index of SQLite"""
+
+    ACTIVE = "user NOT IN (SELECT user FROM permallowed)"
+
+    def __init__(self, db):
+        self.db = db
+
+    def push(self, user: str, start_date: date):
+        pass  # The expiry date is stored along with the permit
+
+    def next_expiry(self):
+        deadline, = self.db.execute(
+            "SELECT MIN(expires) FROM permits WHERE " + self.ACTIVE
+        ).fetchone()
+        return None if deadline is None else date.fromordinal(deadline)
+
+    def pop_expired(self, today: date):
+        return [row[0] for row in self.db.execute(
+            "SELECT user FROM permits WHERE expires < ? AND " + self.ACTIVE
+            + " ORDER BY expires",
+            (today.toordinal(),),
+        )]
+
+
+class SqliteAllowlist(WikiAllowlist):
+    """
+    Allowlist kept in a local SQLite database, indexed by user and expiry
+    date, the wiki page being an export of it.
+
+    The page is imported again whenever its latest revision is not the one
+    the database was last synchronized with (e.g. after a moderator edited
+    it), and only exported when the permits changed. Pending changes are
+    stored in the database too, so that they get exported even if the bot
+    crashes before committing them.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS permits (
+        user TEXT PRIMARY KEY COLLATE NOCASE,
+        start_date INTEGER NOT NULL,
+        expires INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS permits_expires ON permits (expires);
+    CREATE TABLE IF NOT EXISTS permallowed (
+        user TEXT PRIMARY KEY COLLATE NOCASE
+    );
+    CREATE TABLE IF NOT EXISTS pending (
+        user TEXT PRIMARY KEY COLLATE NOCASE,
+        start_date INTEGER  -- NULL for deletions
+    );
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    def __init__(self, subreddit, path=':memory:', **kwargs):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.SCHEMA)
+        super().__init__(subreddit, **kwargs)
+
+        # Changes which were not committed before the last run stopped
+        for user, start_date in self.db.execute("SELECT * FROM pending"):
+            if start_date is None:
+                self.to_delete.append(user)
+            else:
+                self.to_update[user] = date.fromordinal(start_date)
+        with self.db:
+            self._apply_pending()
+
+    def _meta(self, key):
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def _set_meta(self, key, value):
+        self.db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            (key, value),
+        )
+
+    def reload(self):
+        wiki_page = self.subreddit.wiki[self.page]
+        latest = next(iter(wiki_page.revisions(limit=1)), None)
+        if latest is None or latest['id'] != self._meta('revision_id'):
+            self._import(self.serializer.load(wiki_page.content_md),
+                         wiki_page.revision_id)
+
+        self.revision_id = self._meta('revision_id')
+        self.allowlist = self.serializer.load(self._meta('extra'))
+        self.allowlist[self.PERMIT_KEY] = SqlitePermits(self.db,
+                                                        self.permit_length)
+        self.allowlist[self.PERMALLOWED_KEY] = [
+            row[0] for row in self.db.execute("SELECT user FROM permallowed")
+        ]
+        self._permallowed = UserSet(self.allowlist[self.PERMALLOWED_KEY])
+        self.expiries = SqliteExpiryIndex(self.db)
+
+    def _import(self, document, revision_id):
+        document = dict(document)
+        permits = document.pop(self.PERMIT_KEY)
+        permallowed = document.pop(self.PERMALLOWED_KEY)
+        with self.db:
+            self.db.execute("DELETE FROM permits")
+            self.db.executemany(
+                "INSERT INTO permits (user, start_date, expires) "
+                "VALUES (?, ?, ?)",
+                [
+                    (user, start_date.toordinal(),
+                     expiry_ordinal(start_date, self.permit_length))
+                    for user, start_date in permits.items()
+                ],
+            )
+            self.db.execute("DELETE FROM permallowed")
+            self.db.executemany(
+                "INSERT OR IGNORE INTO permallowed (user) VALUES (?)",
+                [(user,) for user in permallowed],
+            )
+            self._set_meta('extra', self.serializer.dump(document))
+            self._set_meta('revision_id', revision_id)
+
+    def update(self, user: str, start_date: date):
+        with self.db:
+            added = super().update(user, start_date)
+            if added:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO pending VALUES (?, ?)",
+                    (user, start_date.toordinal()),
+                )
+        return added
+
+    def delete(self, user: str):
+        with self.db:
+            super().delete(user)
+            self.db.execute(
+                "INSERT OR REPLACE INTO pending VALUES (?, NULL)", (user,)
+            )
+
+    def commit(self):
+        with self.db:
+            super().commit()
+            self.db.execute("DELETE FROM pending")
+            self._set_meta('revision_id', self.revision_id)
+
+
+class ContributorRoster:
+    """
+    Approved users of a subreddit, looked up either one by one or from a
+    snapshot of the whole listing, whichever takes fewer requests.
+
+    A user is probed with the ``redditor`` filter of the contributor
+    listing, which takes one request, while the snapshot pages through the
+    listing once, PAGE_SIZE users per request, and then answers any number
+    of lookups. The size of the listing is kept in the bot state, so later
+    runs can tell which is cheaper before fetching it. Without a state, or
+    before the first snapshot, the listing is fetched.
+
+    Either way, the roster is kept in sync with the additions and removals
+    made through it.
+    """
+
+    STATE_KEY = 'contributor_count'
+    PAGE_SIZE = 100
+
+    def __init__(self, subreddit, state=None):
+        self.subreddit = subreddit
+        self.state = state
+        self._contributors = None
+        self._probed = {}
+        # add and remove are called from the workers of an ActionQueue
+        self.lock = threading.Lock()
+
+    @property
+    def contributors(self):
+        if self._contributors is None:
+            self._contributors = {
+                normalize_username(u)
+                for u in self.subreddit.contributor(limit=None)
+            }
+            if self.state is not None:
+                self.state[self.STATE_KEY] = len(self._contributors)
+        return self._contributors
+
+    def pages(self):
+        """Requests a snapshot would take, None if unknown"""
+        count = None if self.state is None else self.state.get(self.STATE_KEY)
+        if count is None:
+            return None
+        return max(1, math.ceil(count / self.PAGE_SIZE))
+
+    def probe(self, user):
+        """Whether user is a contributor, in a single request"""
+        key = normalize_username(user)
+        return any(normalize_username(u) == key
+                   for u in self.subreddit.contributor(redditor=key))
+
+    def lookup(self, users):
+        """
+        Find out which of ``users`` are contributors, by probing them if
+        there are no more of them than pages in the listing, or else by
+        taking a snapshot.
+        """
+        if self._contributors is not None:
+            return
+        keys = {normalize_username(user) for user in users}
+        keys -= self._probed.keys()
+        if not keys:
+            return
+        pages = self.pages()
+        if pages is None or len(keys) > pages:
+            self.contributors
+            return
+        for key in sorted(keys):
+            self._probed[key] = self.probe(key)
+
+    def __contains__(self, user):
+        self.lookup([user])
+        key = normalize_username(user)
+        if self._contributors is not None:
+            return key in self._contributors
+        return self._probed[key]
+
+    def missing(self, users):
+        """
+        Those of ``users`` who are not contributors, sorted, as a single set
+        difference with the listing.
+        """
+        wanted = {normalize_username(user): user for user in users}
+        self.lookup(wanted)
+        if self._contributors is not None:
+            known = self._contributors
+        else:
+            known = {key for key, found in self._probed.items() if found}
+        return [wanted[key] for key in sorted(wanted.keys() - known)]
+
+    def add(self, user):
+        self.subreddit.contributor.add(user)
+        self._update(normalize_username(user), True)
+
+    def remove(self, user):
+        self.subreddit.contributor.remove(user)
+        self._update(normalize_username(user), False)
+
+    def _update(self, key, present):
+        with self.lock:
+            if self._contributors is not None:
+                was_present = key in self._contributors
+                if present:
+                    self._contributors.add(key)
+                else:
+                    self._contributors.discard(key)
+            else:
+                was_present = self._probed.get(key, not present)
+                self._probed[key] = present
+            if was_present != present and self.pages() is not None:
+                self.state[self.STATE_KEY] += 1 if present else -1
+
+
+class ModeratorRoster:
+    """
+    Moderators of a subreddit, cached in the bot state for ``ttl`` seconds so
+    that consecutive oneshot runs do not refetch the list every time.
+    """
+
+    STATE_KEY = 'moderators'
+
+    def __init__(self, subreddit, state, ttl=MODERATOR_TTL):
+        self.subreddit = subreddit
+        self.state = state
+        self.ttl = ttl
+        self._moderators = None
+
+    @property
+    def moderators(self):
+        cached = self.state.get(self.STATE_KEY)
+        if cached is None or time.time() - cached['fetched_at'] >= self.ttl:
+            cached = {
+                'fetched_at': time.time(),
+                'names': sorted(
+                    normalize_username(m) for m in self.subreddit.moderator()
+                ),
+            }
+            self.state[self.STATE_KEY] = cached
+            self._moderators = None
+        if self._moderators is None:
+            self._moderators = frozenset(cached['names'])
+        return self._moderators
+
+    def __contains__(self, user):
+        return normalize_username(user) in self.moderators
+
+
+class ActionQueue:
+    """
+    Side effects of a phase (contributor changes, PMs), collected while the
+    phase looks at the allowlist and then performed concurrently.
+
+    An action is a sequence of steps run in order, each step only being run
+    if the previous one succeeded. Steps failing with a transient error are
+    retried with an exponential backoff.
+    """
+
+    def __init__(self, reddit, workers=ACTION_WORKERS, retries=ACTION_RETRIES,
+                 backoff=1):
+        self.reddit = reddit
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.actions = []
+
+    def add(self, description, *steps):
+        self.actions.append((description, steps))
+
+    def run(self):
+        """Perform the queued actions, return the ones which succeeded"""
+        if not self.actions:
+            return []
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(self._perform, self.actions))
+        succeeded = [
+            description
+            for (description, _), ok in zip(self.actions, results) if ok
+        ]
+        logging.info(
+            "[ACTIONS] %d/%d actions succeeded",
+            len(succeeded),
+            len(self.actions),
+        )
+        self.actions = []
+        return succeeded
+
+    def _perform(self, action):
+        description, steps = action
+        for step in steps:
+            for attempt in range(self.retries + 1):
+                self._wait_for_ratelimit()
+                try:
+                    step()
+                    break
+                except (
+                    prawcore.exceptions.RequestException,
+                    prawcore.exceptions.ServerError,
+                    prawcore.exceptions.TooManyRequests,
+                ) as e:
+                    if attempt == self.retries:
+                        logging.warning("Could not %s: %s", description, e)
+                        return False
+                    time.sleep(self.backoff * 2 ** attempt)
+                except (
+                    praw.exceptions.RedditAPIException,
+                    prawcore.exceptions.BadRequest,
+                    prawcore.exceptions.Forbidden,
+                    prawcore.exceptions.NotFound,
+                ) as e:  # e.g. banned user
+                    logging.warning("Could not %s: %s", description, e)
+                    return False
+        return True
+
+    def _wait_for_ratelimit(self):
+        """
+        Wait for the rate limit window to reset when there are fewer requests
+        left in it than concurrent workers. PRAW spaces out the requests
+        otherwise.
+        """
+        limits = self.reddit.auth.limits
+        remaining = limits.get('remaining')
+        reset = limits.get('reset_timestamp')
+        if (
+            isinstance(remaining, (int, float))
+            and isinstance(reset, (int, float))
+            and remaining < self.workers
+        ):
+            time.sleep(max(0, reset - time.time()))
+
+
+class Outbox:
+    """
+    Journal of the PMs the bot intends to send, in a SQLite database.
+
+    Each PM has an idempotency key, e.g. the user and permit it is about:
+    queueing a PM whose key is already known does nothing, so work redone
+    after a crash never messages a user twice. PMs are kept once sent, and
+    queued PMs survive a crash until they are sent by a later run.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS outbox (
+        key TEXT PRIMARY KEY,
+        user TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        text TEXT NOT NULL,
+        created REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        sent REAL
+    );
+    CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (sent, created);
+    """
+
+    def __init__(self, path=':memory:'):
+        # PMs are queued and sent from the ActionQueue worker threads
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.executescript(self.SCHEMA)
+
+    def enqueue(self, key, user, subject, text):
+        """Queue a PM, return whether it was not already known"""
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO outbox (key, user, subject, text, "
+                "created) VALUES (?, ?, ?, ?, ?)",
+                (key, user, subject, text, time.time()),
+            )
+        return cursor.rowcount == 1
+
+    def pending(self):
+        """PMs not sent yet, oldest first, as (key, user, subject, text)"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT key, user, subject, text FROM outbox "
+                "WHERE sent IS NULL AND attempts < ? ORDER BY created",
+                (OUTBOX_ATTEMPTS,),
+            ).fetchall()
+
+    def attempt(self, key):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE outbox SET attempts = attempts + 1 WHERE key = ?",
+                (key,),
+            )
+
+    def mark_sent(self, key):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE outbox SET sent = ? WHERE key = ?",
+                (time.time(), key),
+            )
+
+    def prune(self, max_age):
+        """Forget the PMs sent or given up on more than max_age seconds ago"""
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM outbox WHERE created < ? "
+                "AND (sent IS NOT NULL OR attempts >= ?)",
+                (time.time() - max_age, OUTBOX_ATTEMPTS),
+            )
+
+
+class RequestBudget:
+    """
+    Requests left in the current rate limit window, as last reported by
+    Reddit. Low priority work only spends what is above ``reserve``, and is
+    deferred to the next run otherwise.
+    """
+
+    def __init__(self, reddit, reserve=REQUEST_RESERVE):
+        self.reddit = reddit
+        self.reserve = reserve
+
+    def available(self):
+        """Number of requests that low priority work may still make"""
+        remaining = self.reddit.auth.limits.get('remaining')
+        if not isinstance(remaining, (int, float)):  # no request made yet
+            return sys.maxsize
+        return max(0, int(remaining) - self.reserve)
+
+
+class RunMetrics:
+    """
+    Wall time, Reddit requests, bytes received and items handled by each
+    phase of a run, the phases being keyed by subreddit and name.
+
+    Requests are counted by CountingRequestor, and charged to the innermost
+    phase running when they complete, so a phase that runs others does not
+    count their share. Whatever happens outside of any phase only shows in
+    the totals.
+    """
+
+    FIELDS = ('seconds', 'requests', 'bytes', 'items')
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes = 0
+        self.started = time.monotonic()
+        self.phases = {}
+        self.stack = []
+        self.mark = (self.started, 0, 0)
+
+    def record(self, size):
+        """Count a request which received ``size`` bytes"""
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+
+    def _charge(self):
+        """Charge what happened since the last mark to the current phase"""
+        with self.lock:
+            mark = (time.monotonic(), self.requests, self.bytes)
+        if self.stack:
+            stats = self.phases[self.stack[-1]]
+            stats['seconds'] += mark[0] - self.mark[0]
+            stats['requests'] += mark[1] - self.mark[1]
+            stats['bytes'] += mark[2] - self.mark[2]
+        self.mark = mark
+
+    @contextmanager
+    def phase(self, subreddit, name):
+        self._charge()
+        key = (subreddit, name)
+        self.phases.setdefault(key, dict.fromkeys(self.FIELDS, 0))
+        self.stack.append(key)
+        try:
+            yield
+        finally:
+            self._charge()
+            self.stack.pop()
+
+    def items(self, count):
+        """Add to the items handled by the current phase"""
+        if self.stack:
+            self.phases[self.stack[-1]]['items'] += count
+
+    def report(self):
+        """
+        Log the metrics of the run as JSON lines, one per phase and one for
+        the totals, and write them to the Prometheus textfile if any.
+        """
+        for (subreddit, name), stats in self.phases.items():
+            logging.info("[METRICS] %s", json.dumps(dict(
+                subreddit=subreddit, phase=name, **stats
+            )))
+        totals = {
+            'seconds': time.monotonic() - self.started,
+            'requests': self.requests,
+            'bytes': self.bytes,
+        }
+        logging.info("[METRICS] %s", json.dumps(dict(phase='total',
+                                                     **totals)))
+        if self.path is not None:
+            self.write_textfile(totals)
+
+    def write_textfile(self, totals):
+        """Write the metrics in the text format of node_exporter"""
+        lines = []
+        for field in self.FIELDS:
+            lines.append('# TYPE hoa_bot_phase_{} gauge'.format(field))
+            for (subreddit, name), stats in self.phases.items():
+                lines.append(
+                    'hoa_bot_phase_{}{{subreddit="{}",phase="{}"}} {}'
+                    .format(field, subreddit, name, stats[field])
+                )
+        for field, value in totals.items():
+            lines.append('# TYPE hoa_bot_run_{} gauge'.format(field))
+            lines.append('hoa_bot_run_{} {}'.format(field, value))
+        lines.append('# TYPE hoa_bot_last_run_timestamp_seconds gauge')
+        lines.append('hoa_bot_last_run_timestamp_seconds {}'
+                     .format(time.time()))
+        # node_exporter may read the file at any time
+        atomic_write(self.path, '\n'.join(lines) + '\n')
+
+
+class CountingRequestor:
+    """
+    prawcore Requestor recording each response in a RunMetrics. It wraps
+    one rather than subclassing it, so that prawcore is only imported once
+    the bot connects.
+    """
+
+    def __init__(self, *args, metrics, **kwargs):
+        self.requestor = prawcore.Requestor(*args, **kwargs)
+        self.metrics = metrics
+
+    def __getattr__(self, attribute):
+        return getattr(self.requestor, attribute)
+
+    def request(self, *args, **kwargs):
+        response = self.requestor.request(*args, **kwargs)
+        self.metrics.record(len(response.content))
+        return response
+
+
+class RIRule:
+    """What makes a submission of a network subreddit a sufficient RI"""
+
+    def __init__(self, flair=RI_FLAIR, min_score=None):
+        self.flair = flair
+        self.min_score = min_score
+
+    @classmethod
+    def from_config(cls, config, subreddit, flair=RI_FLAIR):
+        """Rule from the ``[ri:<subreddit>]`` section of the configuration"""
+        section = 'ri:' + subreddit
+        min_score = config_option(config, section, 'min_score')
+        return cls(
+            flair=config_option(config, section, 'flair', flair) or None,
+            min_score=int(min_score) if min_score else None,
+        )
+
+    def check(self, submission):
+        """
+        True if the submission is sufficient, False if it is not, and None
+        if it could still become so, being unflaired or short of votes.
+        A rule without flair accepts any submission with enough votes.
+        """
+        if self.flair is not None:
+            if submission.link_flair_text is None:
+                return None
+            if submission.link_flair_text != self.flair:
+                return False
+        if self.min_score is not None and submission.score < self.min_score:
+            return None
+        return True
+
+
+class Plan:
+    """
+    What a run on one subreddit would do, computed by WallBot.plan without
+    doing any of it, to be reviewed and applied later by WallBot.apply.
+
+    It holds the permits to grant and to expire, the diff they make to the
+    wiki page, the actions the run would queue, as descriptions and WallBot
+    method calls, the PMs already waiting in the outbox, and the bot state
+    as the run would leave it. It is saved as JSON.
+    """
+
+    def __init__(self, subreddit, created=None, permits=None, expired=None,
+                 wiki_diff='', actions=None, sends=None, state=None):
+        self.subreddit = subreddit
+        self.created = time.time() if created is None else created
+        self.permits = {} if permits is None else permits
+        self.expired = {} if expired is None else expired
+        self.wiki_diff = wiki_diff
+        self.actions = [] if actions is None else actions
+        self.sends = [] if sends is None else sends
+        self.state = {} if state is None else state
+
+    def add(self, description, *steps):
+        """Record an action instead of queuing it, see ActionQueue.add"""
+        self.actions.append({
+            'description': description,
+            'steps': [[step.func.__name__, *step.args] for step in steps],
+        })
+
+    def run(self):
+        """Nothing is done when planning, so no action has succeeded"""
+        return []
+
+    def describe(self):
+        lines = ["/r/{} (planned {})".format(
+            self.subreddit,
+            datetime.fromtimestamp(self.created).isoformat(timespec='seconds')
+        )]
+        lines.extend(
+            "  permit /u/{} from {}".format(user, start)
+            for user, start in self.permits.items()
+        )
+        lines.extend(
+            "  expire /u/{}'s permit from {}".format(user, start)
+            for user, start in self.expired.items()
+        )
+        lines.extend("  " + action['description'] for action in self.actions)
+        lines.extend(
+            "  send queued PM to /u/{}: {}".format(user, subject)
+            for user, subject in self.sends
+        )
+        if self.wiki_diff:
+            lines.extend("    " + line for line in self.wiki_diff.split('\n'))
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_json(cls, document):
+        return cls(**document)
+
+
+class TokenStore:
+    """
+    Access token of the bot, kept in a file between oneshot runs so that
+    each of them does not start by logging in again.
+
+    PRAW's token managers only deal with refresh tokens, which script apps
+    do not get, so the token is handed to prawcore's script authorizer
+    directly. Should Reddit reject it, prawcore logs in again by itself.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def token(self):
+        """The stored access token, if it is valid for a while still"""
+        if self.path is None or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+        except ValueError:
+            return None
+        if stored['expires_at'] - time.time() < TOKEN_MARGIN:
+            return None
+        return stored
+
+    def load(self, reddit):
+        """Give the stored token, if any, to a freshly created praw.Reddit"""
+        stored = self.token()
+        if stored is None:
+            return
+        authorizer = reddit._core._authorizer
+        authorizer.access_token = stored['access_token']
+        authorizer.scopes = set(stored['scopes'])
+        remaining = stored['expires_at'] - time.time()
+        # prawcore 3+ times tokens with the monotonic clock, earlier
+        # versions with the wall clock
+        authorizer._expiration_timestamp_ns = (
+            time.monotonic_ns() + int(remaining * 1e9)
+        )
+        authorizer._expiration_timestamp = stored['expires_at']
+
+    def save(self, reddit):
+        if self.path is None:
+            return
+        authorizer = reddit._core._authorizer
+        if authorizer.access_token is None:
+            return
+        if hasattr(authorizer, '_expiration_timestamp_ns'):
+            expires_at = time.time() + (
+                authorizer._expiration_timestamp_ns - time.monotonic_ns()
+            ) / 1e9
+        else:
+            expires_at = authorizer._expiration_timestamp
+        stored = {
+            'access_token': authorizer.access_token,
+            'scopes': sorted(authorizer.scopes or ()),
+            'expires_at': expires_at,
+        }
+        # Readable by the bot's user only
+        atomic_write(self.path, json.dumps(stored), mode=0o600)
+
+
+def connect(config, metrics, tokens=None):
+    """
+    Reddit session of the bot, with its stored access token if any, and
+    a connection pool as large as the action queues and prefetches it
+    serves.
+    """
+    import requests
+
+    workers = max(
+        int(subreddit_option(config, name, 'action_workers', ACTION_WORKERS))
+        for name in subreddit_names(config)
+    )
+    session = requests.Session()
+    # Connections to www.reddit.com, for tokens, and to oauth.reddit.com
+    session.mount('https://', requests.adapters.HTTPAdapter(
+        pool_connections=2, pool_maxsize=max(workers, PREFETCH_WORKERS),
+    ))
+    reddit = praw.Reddit(
+        client_id=config['reddit']['client_id'],
+        client_secret=config['reddit']['client_secret'],
+        username=config['reddit']['username'],
+        password=config['reddit']['password'],
+        user_agent=USER_AGENT,
+        ratelimit_seconds=120,
+        requestor_class=CountingRequestor,
+        requestor_kwargs={'metrics': metrics, 'session': session},
+    )
+    if tokens is not None:
+        tokens.load(reddit)
+    return reddit
+
+
 class WallBot:
-    def __init__(self, config):
+    # Methods called with the conversations fetched by process_modmail
+    MODMAIL_HANDLERS = ('allow_from_modmail',)
+    # Steps of a run, the critical ones first
+    RUN_PHASES = (
+        'prefetch',
+        'allow_from_RIs',
+        'process_modmail',
+        'remove_expired_permits',
+        'commit_allowlist',
+        'grant_permits',
+        'send_notifications',
+        'archive_modmail_notifs',
+    )
+
+    name = SUBREDDIT
+    ri_flair = RI_FLAIR
+    ri_rules = {SUBREDDIT: RIRule()}
+    permit_length = PERMIT_LENGTH
+    action_workers = ACTION_WORKERS
+    # Plan the effects of the run are recorded in instead of being made
+    planned = None
+    # Methods that the actions of a plan may call
+    PLAN_STEPS = (
+        'add_contributor',
+        'remove_contributor',
+        'notify',
+        'reply_modmail',
+        'archive_modmail',
+    )
+
+    def __init__(self, config, name=SUBREDDIT, reddit=None, state=None,
+                 outbox=None, metrics=None):
+        """
+        Settings are read from the ``[subreddit:<name>]`` section of the
+        configuration, then from ``[bot]``. ``reddit``, ``state``,
+        ``outbox`` and ``metrics`` can be shared with the bots of other
+        subreddits, ``metrics`` being the one ``reddit`` reports to.
+        """
         self.config = config
-        self.reddit = praw.Reddit(
-            client_id=config['reddit']['client_id'],
-            client_secret=config['reddit']['client_secret'],
-            username=config['reddit']['username'],
-            password=config['reddit']['password'],
-            user_agent='BadEconomics Zoning Bot',
-            ratelimit_seconds=120,
+        self.name = name
+        if metrics is None:
+            metrics = RunMetrics(self.option('metrics_file') or None)
+        self.metrics = metrics
+        if reddit is None:
+            reddit = connect(config, self.metrics)
+        self.reddit = reddit
+        self.subreddit = self.reddit.subreddit(name)
+        self.ri_flair = self.option('ri_flair', RI_FLAIR)
+        self.ri_rules = {
+            subreddit.lower(): RIRule.from_config(config, subreddit,
+                                                  self.ri_flair)
+            for subreddit in ri_subreddits(config, name)
+        }
+        self.permit_length = int(self.option('permit_length', PERMIT_LENGTH))
+        if state is None:
+            state = BotState(self.option('state_file', STATE_FILE))
+        self.state = state
+
+        allowlist_kwargs = {
+            'page': self.option('wiki_page', WIKI_PAGE),
+            'permit_length': self.permit_length,
+        }
+        allowlist_db = subreddit_path(config, name, 'allowlist_db')
+        if allowlist_db:
+            self.allowlist = SqliteAllowlist(
+                self.subreddit, allowlist_db, **allowlist_kwargs
+            )
+        else:
+            self.allowlist = WikiAllowlist(
+                self.subreddit,
+                cache_path=subreddit_path(config, name, 'wiki_cache',
+                                          WIKI_CACHE),
+                **allowlist_kwargs
+            )
+        self.contributors = ContributorRoster(self.subreddit, self.state)
+        # Reads made ahead by prefetch, taken by the phases that need them
+        self.snapshot = {}
+        self.moderators = ModeratorRoster(
+            self.subreddit,
+            self.state,
+            ttl=int(self.option('moderator_ttl', MODERATOR_TTL)),
+        )
+        self.action_workers = int(self.option('action_workers',
+                                              ACTION_WORKERS))
+        self.budget = RequestBudget(
+            self.reddit,
+            reserve=int(self.option('request_reserve', REQUEST_RESERVE)),
         )
-        self.subreddit = self.reddit.subreddit('badeconomics')
-        self.allowlist = WikiAllowlist(self.subreddit)
+        if outbox is None:
+            outbox = Outbox(self.option('outbox', OUTBOX_FILE))
+        self.outbox = outbox
+
+    def option(self, option, default=None):
+        return subreddit_option(self.config, self.name, option, default)
 
     def run(self):
-        self.allow_from_RIs()
-        self.allow_from_modmail()
-        self.remove_expired_permits()
-        self.grant_permits()
-        self.archive_modmail_notifs()
+        self.contributors = ContributorRoster(self.subreddit, self.state)
+        self.snapshot = {}
+        for phase in self.RUN_PHASES:
+            self.run_phase(phase)
+        self.state.save()
+        self.metrics.report()
+        self.metrics.reset()
+
+    def run_phase(self, phase, *args):
+        with self.metrics.phase(self.name, phase):
+            getattr(self, phase)(*args)
+
+    def commit(self):
+        """
+        Commit the allowlist first, then spend what is left of the request
+        budget on notifications, and save the state.
+        """
+        self.commit_allowlist()
+        self.send_notifications()
+        self.state.save()
+
+    def commit_allowlist(self):
+        self.metrics.items(
+            len(self.allowlist.to_update) + len(self.allowlist.to_delete)
+        )
+        if self.planned is not None:
+            self.plan_allowlist()
+            return
         self.allowlist.commit()
+        # For the startup probe of the next oneshot run
+        next_expiry = self.allowlist.next_expiry()
+        self.state['next_expiry'] = (
+            next_expiry.isoformat() if next_expiry is not None else None
+        )
 
-    def allow_from_RIs(self, backlog=50):
-        """Automatically add people with submissions marked as sufficient"""
+    def plan(self):
+        """
+        Compute what a run would do from what Reddit holds now, without
+        changing anything on Reddit or on disk, and return it as a Plan.
+        """
+
+        if isinstance(self.allowlist, SqliteAllowlist):
+            # Its pending changes are written to the database as they happen
+            self.allowlist = WikiAllowlist(self.subreddit,
+                                           page=self.allowlist.page,
+                                           permit_length=self.permit_length)
+        self.planned = Plan(self.name)
+        self.contributors = ContributorRoster(self.subreddit, self.state)
+        self.snapshot = {}
+        try:
+            for phase in self.RUN_PHASES:
+                self.run_phase(phase)
+            self.planned.state = self.state.data
+            return self.planned
+        finally:
+            self.planned = None
 
-        for submission in self.subreddit.new(limit=backlog):
-            if not submission.author:  # deleted users
+    def plan_allowlist(self):
+        """Record the pending changes of the allowlist, and their wiki diff"""
+
+        self.planned.permits = {
+            user: start_date.isoformat()
+            for user, start_date in self.allowlist.to_update.items()
+        }
+        if not self.allowlist.to_update and not self.allowlist.to_delete:
+            return
+        wiki = self.allowlist.subreddit.wiki
+        before = wiki[self.allowlist.page].content_md
+        after = self.allowlist.serializer.dump(self.allowlist.document())
+        self.planned.wiki_diff = '\n'.join(difflib.unified_diff(
+            before.splitlines(), after.splitlines(),
+            'wiki/' + self.allowlist.page, 'wiki/' + self.allowlist.page,
+            lineterm='',
+        ))
+
+    def apply(self, plan):
+        """
+        Make the changes of a plan, as the run that computed it would have.
+
+        Permits are applied to the allowlist as it is now, so a permit
+        renewed since the plan was made is not expired, and the bot state
+        is the one the run would have left.
+        """
+
+        self.contributors = ContributorRoster(self.subreddit, self.state)
+        for user, start in plan.permits.items():
+            self.allowlist.update(user, date.fromisoformat(start))
+        renewed = set()
+        for user, start in plan.expired.items():
+            start_date = self.allowlist.permits().get(user)
+            if start_date is not None and start_date.isoformat() == start:
+                self.allowlist.delete(user)
+            else:
+                logging.info("Not expiring /u/%s, whose permit changed "
+                             "since the plan was made.", user)
+                renewed.add(normalize_username(user))
+
+        actions = self.action_queue()
+        for action in plan.actions:
+            steps = []
+            for name, *args in action['steps']:
+                if name not in self.PLAN_STEPS:
+                    raise ValueError("Unknown plan step {!r}".format(name))
+                steps.append(partial(getattr(self, name), *args))
+            if any(name == 'remove_contributor'
+                   and normalize_username(args[0]) in renewed
+                   for name, *args in action['steps']):
                 continue
+            actions.add(action['description'], *steps)
+        actions.run()
+
+        self.state.data.clear()
+        self.state.data.update(plan.state)
+        self.commit()
+
+    def action_queue(self):
+        """Queue for the effects of a phase, or the plan when planning"""
+        if self.planned is not None:
+            return self.planned
+        return ActionQueue(self.reddit, workers=self.action_workers)
+
+    def add_contributor(self, user_str):
+        self.contributors.add(self.reddit.redditor(user_str))
+
+    def remove_contributor(self, user_str):
+        self.contributors.remove(self.reddit.redditor(user_str))
+
+    def reply_modmail(self, conversation_id, text):
+        self.subreddit.modmail(conversation_id).reply(body=text)
+
+    def archive_modmail(self, conversation_id):
+        self.subreddit.modmail(conversation_id).archive()
+
+    def daemon(self, sweep_interval=SWEEP_INTERVAL,
+               poll_interval=POLL_INTERVAL):
+        Network([self]).daemon(sweep_interval, poll_interval)
+
+    def daemon_round(self, flair_log, modmail):
+        """Handle the items yielded by the daemon streams since last round"""
+
+        fullnames = [
+            entry.target_fullname for entry in iter(flair_log.__next__, None)
+            if entry.target_fullname
+            and entry.target_fullname.startswith('t3_')
+        ]
+        if fullnames:
+            for submission in self.reddit.info(fullnames=fullnames):
+                self.allow_from_submission(submission)
+
+        conversations = list(iter(modmail.__next__, None))
+        if conversations:
+            self.handle_modmail(conversations)
+
+        if self.allowlist.to_update:
+            self.grant_permits()
+            self.commit()
+        if conversations:
+            self.archive_modmail_notifs(conversations)
+
+    def ri_listing(self):
+        """
+        The subreddits where RIs are looked for, as a single multireddit
+        when there are several so that they are paged through at once.
+        """
+        if list(self.ri_rules) == [self.name.lower()]:
+            return self.subreddit
+        return self.reddit.subreddit('+'.join(self.ri_rules))
+
+    def prefetch(self):
+        """
+        Make the reads of a run that do not depend on each other all at
+        once, so that the run waits for the slowest of them rather than for
+        each in turn. Their results are left in ``snapshot`` for the phases
+        that need them, the rosters keeping their own.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        reads = {
+            'submissions': self.fetch_submissions,
+            'rechecked': self.fetch_pending,
+            'conversations': self.fetch_conversations,
+        }
+        # The allowlist may be a SqliteAllowlist, only usable by this thread
+        users = list(itertools.chain(self.allowlist.permits(),
+                                     self.allowlist.permallowed()))
+        rosters = [
+            lambda: self.moderators.moderators,
+            lambda: self.contributors.lookup(users),
+        ]
+        with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as executor:
+            futures = {
+                name: executor.submit(read) for name, read in reads.items()
+            }
+            for future in [executor.submit(read) for read in rosters]:
+                future.result()
+        self.snapshot = {
+            name: future.result() for name, future in futures.items()
+        }
+        self.metrics.items(len(reads) + len(rosters))
+
+    def fetch_submissions(self, backlog=50):
+        """
+        The submissions of the RI listing newer than the RI cursor, or the
+        last ``backlog`` ones when there is no cursor yet.
+        """
+        cursor = self.state.get('ri_cursor')
+        submissions = []
+        limit = backlog if cursor is None else None
+        for submission in self.ri_listing().new(limit=limit):
+            if cursor is not None and (
+                submission.fullname == cursor['fullname']
+                or submission.created_utc < cursor['created_utc']
+            ):
+                break
+            submissions.append(submission)
+        return submissions
+
+    def fetch_pending(self):
+        """The submissions that could still become sufficient RIs"""
+        pending = list(self.state.get('ri_pending', {}))
+        if not pending:
+            return []
+        return list(self.reddit.info(fullnames=pending))
+
+    def fetch_conversations(self, backlog=25):
+        return list(self.subreddit.modmail.conversations(limit=backlog))
+
+    def allow_from_RIs(self, backlog=50):
+        """
+        Automatically add people with submissions marked as sufficient, in
+        any of the subreddits of ``ri_rules``.
+
+        The newest submission seen is kept in the bot state as a cursor, and
+        each run pages through the new submissions until it reaches it, so
+        that no post is missed however many were made since the last run.
+        ``backlog`` only bounds the first run, ``None`` going as far back as
+        Reddit allows.
+
+        RIs are usually flaired some time after being posted, so the posts
+        that had no flair yet when they were seen are rechecked in batch on
+        the following runs, for RI_PENDING_DAYS days. So are the ones which
+        do not have the score their subreddit requires yet.
+        """
+
+        if 'submissions' in self.snapshot:
+            submissions = self.snapshot.pop('submissions')
+            rechecked = self.snapshot.pop('rechecked')
+        else:
+            submissions = self.fetch_submissions(backlog)
+            rechecked = self.fetch_pending()
+        if submissions:
+            self.state['ri_cursor'] = {
+                'fullname': submissions[0].fullname,
+                'created_utc': submissions[0].created_utc,
+            }
+
+        seen = {submission.fullname for submission in submissions}
+        submissions.extend(submission for submission in rechecked
+                           if submission.fullname not in seen)
+        self.metrics.items(len(submissions))
+
+        cutoff = time.time() - RI_PENDING_DAYS * 24 * 3600
+        pending = {}
+        for submission in submissions:
+            sufficient = self.allow_from_submission(submission)
+            if sufficient is None and submission.created_utc >= cutoff:
+                pending[submission.fullname] = submission.created_utc
+        self.state['ri_pending'] = pending
+
+    def allow_from_submission(self, submission):
+        """
+        Mark the author of a submission for a permit if it is sufficient,
+        according to the rule of its subreddit, which is returned.
+        """
+
+        if not submission.author:  # deleted users
+            return False
+        rule = self.ri_rules.get(str(submission.subreddit).lower())
+        if rule is None:
+            return False
+        sufficient = rule.check(submission)
+        if sufficient:
             author = str(submission.author)
             submission_date = date.fromtimestamp(submission.created_utc)
-            if submission.link_flair_text == 'Sufficient':
-                added = self.allowlist.update(author, submission_date)
-                if added:
-                    logging.info("[RI] Marked %s for a permit", author)
+            added = self.allowlist.update(author, submission_date)
+            if added:
+                logging.info("[RI] Marked %s for a permit (/r/%s)", author,
+                             submission.subreddit)
+        return sufficient
 
-    def allow_from_modmail(self, backlog=25):
-        """Automatically add people with submissions marked as sufficient"""
+    def process_modmail(self, backlog=25):
+        """
+        Fetch the latest modmail conversations once and hand them to each of
+        the MODMAIL_HANDLERS in turn. They are left in the snapshot for
+        archive_modmail_notifs, at the end of the run.
+        """
+
+        conversations = self.snapshot.get('conversations')
+        if conversations is None:
+            conversations = self.fetch_conversations(backlog)
+            self.snapshot['conversations'] = conversations
+        if conversations:
+            # For the startup probe of the next oneshot run
+            self.state['modmail_updated'] = max(
+                conv.last_updated for conv in conversations
+            )
+        self.handle_modmail(conversations)
+
+    def handle_modmail(self, conversations):
+        """Run each of the MODMAIL_HANDLERS on a list of conversations"""
+
+        for handler_name in self.MODMAIL_HANDLERS:
+            self.run_phase(handler_name, conversations)
+
+    def allow_from_modmail(self, conversations):
+        """
+        Add people for whom a moderator replied with !allow in modmail.
+
+        The last message handled in each conversation is recorded in the bot
+        state, so that a command is only ever acted upon once, and only the
+        messages posted since the previous run are looked at.
+        """
+
+        self.metrics.items(len(conversations))
+        actions = self.action_queue()
+        seen = self.state.get('modmail_seen', {})
+        for conv in conversations:
+            messages = list(conv.messages)
+            message_ids = [m.id for m in messages]
+            if seen.get(conv.id) in message_ids:
+                messages = messages[message_ids.index(seen[conv.id]) + 1:]
+            if message_ids:
+                # Reinsert to keep the most recently active conversations last
+                seen.pop(conv.id, None)
+                seen[conv.id] = message_ids[-1]
 
-        for conv in self.subreddit.modmail.conversations(limit=backlog):
             if not conv.participant:  # deleted users
                 continue
 
             participant = str(conv.participant)
-            for message in conv.messages:
+            for message in messages:
                 if (
                     '!allow' in message.body_markdown
-                    and message.author in self.subreddit.moderator()
+                    and message.author in self.moderators
                 ):
                     command_date = datetime.fromisoformat(message.date).date()
                     added = self.allowlist.update(participant, command_date)
@@ -163,83 +1852,462 @@ class WallBot:
                         logging.info(
                             "[MODMAIL] Marked %s for a permit", participant
                         )
-                        conv.reply(
-                            "Confirmed! Granted cloture to {} for {} days."
-                            .format(participant, PERMIT_LENGTH)
+                        actions.add(
+                            "confirm /u/{}'s permit in modmail"
+                            .format(participant),
+                            partial(
+                                self.reply_modmail,
+                                conv.id,
+                                "Confirmed! Granted cloture to {} for {} days."
+                                .format(participant, self.permit_length),
+                            ),
                         )
+        actions.run()
+
+        self.state['modmail_seen'] = dict(
+            list(seen.items())[-MODMAIL_SEEN_LIMIT:]
+        )
 
     def grant_permits(self):
         """
-        Look at the allowlist for new permits, add users to the contributor
-        list and notify them that they have been added.
-        """
+        Add the users with a permit, and the permallowed ones, who are not
+        contributors yet to the contributor list, and notify the former
+        that they have been added.
 
-        for user_str, date_start in self.allowlist.permits().items():
-            user = self.reddit.redditor(user_str)
-            if user not in self.subreddit.contributor():
-                try:
-                    self.subreddit.contributor.add(user)
-                except Exception:  # banned
-                    continue
+        The users to add are the difference between these and the
+        contributors, so only they cost anything beyond a set operation.
+        """
 
-                # Don't spam permallowed users with permit PMs
-                if user_str in self.allowlist.permallowed():
-                    continue
+        permits = self.allowlist.permits()
+        permallowed = self.allowlist.permallowed()
+        actions = self.action_queue()
+        for user_str in self.contributors.missing(
+            itertools.chain(permits, permallowed)
+        ):
+            if user_str not in permits:
+                actions.add(
+                    "add permallowed /u/{}".format(user_str),
+                    partial(self.add_contributor, user_str),
+                )
+                continue
 
+            steps = [partial(self.add_contributor, user_str)]
+            # Don't spam permallowed users with permit PMs
+            if user_str not in permallowed:
                 logging.info("Granting /u/%s a permit.", user_str)
-
-                expires = date_start + timedelta(PERMIT_LENGTH)
-                user.message(
+                date_start = permits[user_str]
+                expires = date_start + timedelta(self.permit_length)
+                steps.append(partial(
+                    self.notify,
+                    '{}:granted:{}:{}'.format(self.name, user_str,
+                                              date_start),
+                    user_str,
                     PM_GRANTED_SUBJECT.format(user=user_str),
                     PM_GRANTED_TEXT.format(user=user_str, expires=expires)
-                )
+                ))
+            actions.add("grant /u/{} a permit".format(user_str), *steps)
 
-        # Ensure that permallowed users are always contributors
-        for contributor in self.allowlist.permallowed():
-            user = self.reddit.redditor(contributor)
-            if contributor not in self.subreddit.contributor():
-                self.subreddit.contributor.add(user)
+        self.metrics.items(len(actions.run()))
 
     def remove_expired_permits(self):
         """
         Look at the allowlist for expired permits, delete users from the
         allowlist, remove them from the contributor list and notify them that
         they have been removed.
+
+        Only the permits whose expiry date has passed are looked at, as they
+        are popped from the expiry index of the allowlist.
         """
 
-        for user_str, date_start in self.allowlist.permits().copy().items():
-            user = self.reddit.redditor(user_str)
+        actions = self.action_queue()
+        for user_str in self.allowlist.expired():
             if user_str in self.allowlist.permallowed():
                 continue
 
+            date_start = self.allowlist[user_str]
             delta = (date.today() - date_start).days
-            if delta > PERMIT_LENGTH:
-                logging.info(
-                    "Removing /u/%s's expired permit (%s days).",
-                    user_str,
-                    delta,
-                )
-                self.allowlist.delete(user_str)
-                if user in self.subreddit.contributor():
-                    self.subreddit.contributor.remove(user)
-                    user.message(
+            logging.info(
+                "Removing /u/%s's expired permit (%s days).",
+                user_str,
+                delta,
+            )
+            self.allowlist.delete(user_str)
+            if self.planned is not None:
+                self.planned.expired[user_str] = date_start.isoformat()
+            if user_str in self.contributors:
+                actions.add(
+                    "remove /u/{}'s expired permit".format(user_str),
+                    partial(self.remove_contributor, user_str),
+                    partial(
+                        self.notify,
+                        '{}:expired:{}:{}'.format(self.name, user_str,
+                                                  date_start),
+                        user_str,
                         PM_EXPIRE_SUBJECT.format(user=user_str),
                         PM_EXPIRE_TEXT.format(user=user_str)
-                    )
+                    ),
+                )
 
-    def archive_modmail_notifs(self, backlog=25):
-        """Archive annoying contributor notifications in modmail"""
+        self.metrics.items(len(actions.run()))
 
-        for conv in self.subreddit.modmail.conversations(limit=backlog):
-            if conv.subject == 'you are an approved user':
-                conv.archive()
+    def notify(self, key, user_str, subject, text):
+        """
+        Record a PM in the outbox, to be sent by send_notifications once the
+        run is committed. ``key`` identifies the event the PM is about, so
+        that it is only ever sent once.
+        """
+        self.outbox.enqueue(key, user_str, subject, text)
+
+    def send_notifications(self):
+        """
+        Send the PMs of the outbox, as far as the request budget allows. The
+        others are left in the outbox and sent on the next runs.
+        """
+
+        pending = self.outbox.pending()
+        if self.planned is not None:
+            self.planned.sends = [
+                [user_str, subject] for _, user_str, subject, _ in pending
+            ]
+            return
+        available = self.budget.available()
+        if available < len(pending):
+            logging.info(
+                "[BUDGET] Deferring %d notifications to the next run",
+                len(pending) - available,
+            )
+
+        actions = ActionQueue(self.reddit, workers=self.action_workers)
+        for key, user_str, subject, text in pending[:available]:
+            user = self.reddit.redditor(user_str)
+            actions.add(
+                "notify /u/{}".format(user_str),
+                partial(self.outbox.attempt, key),
+                partial(user.message, subject=subject, message=text),
+                partial(self.outbox.mark_sent, key),
+            )
+        self.metrics.items(len(actions.run()))
+        self.outbox.prune(2 * self.permit_length * 24 * 3600)
+
+    def archive_modmail_notifs(self, conversations=None):
+        """
+        Archive annoying contributor notifications in modmail, by default
+        among the conversations fetched by process_modmail. This comes last
+        and is left to the next run when the request budget is short.
+
+        Notifications created by this run's contributor additions are not
+        fetched yet, they get archived on the next run.
+        """
+
+        if conversations is None:
+            conversations = self.snapshot.pop('conversations', [])
+        notifs = [
+            conv for conv in conversations
+            if conv.subject == 'you are an approved user'
+        ]
+        if len(notifs) > self.budget.available():
+            logging.info("[BUDGET] Deferring modmail archiving")
+            return
+        actions = self.action_queue()
+        for conv in notifs:
+            actions.add(
+                "archive modmail notification {}".format(conv.id),
+                partial(self.archive_modmail, conv.id),
+            )
+        self.metrics.items(len(actions.run()))
+
+
+class Network:
+    """
+    Bots of several subreddits sharing a single Reddit session, and with it
+    a single request budget, as well as the state file and the outbox.
+
+    Runs go phase by phase rather than bot by bot, so that the critical
+    phases of every subreddit happen before the notifications of any, and
+    the subreddit going first changes from one run to the next so that none
+    is always the one left short of requests.
+    """
+
+    def __init__(self, bots, state=None, metrics=None):
+        self.bots = list(bots)
+        self.reddit = self.bots[0].reddit
+        self.state = self.bots[0].state if state is None else state
+        self.metrics = self.bots[0].metrics if metrics is None else metrics
+
+    @classmethod
+    def from_config(cls, config, state=None, outbox=None, tokens=None):
+        """
+        One bot per ``[subreddit:<name>]`` section of the configuration, or
+        one for /r/badeconomics if there is none. The state of each bot is
+        kept under its name when there are several.
+        """
+        names = subreddit_names(config)
+        metrics = RunMetrics(
+            config_option(config, 'bot', 'metrics_file') or None
+        )
+        reddit = connect(config, metrics, tokens)
+        if state is None:
+            state = BotState(config_option(config, 'bot', 'state_file',
+                                           STATE_FILE))
+        if outbox is None:
+            outbox = Outbox(config_option(config, 'bot', 'outbox',
+                                          OUTBOX_FILE))
+        bots = [
+            WallBot(config, name, reddit=reddit,
+                    state=state if len(names) == 1 else state.scope(name),
+                    outbox=outbox, metrics=metrics)
+            for name in names
+        ]
+        return cls(bots, state, metrics)
+
+    def rotation(self, items):
+        """``items`` starting from a different one on each call"""
+        if len(items) < 2:
+            return list(items)
+        turn = self.state.get('network_turn', 0) % len(items)
+        self.state['network_turn'] = turn + 1
+        return items[turn:] + items[:turn]
+
+    def run(self):
+        bots = self.rotation(self.bots)
+        for bot in bots:
+            bot.contributors = ContributorRoster(bot.subreddit, bot.state)
+            bot.snapshot = {}
+        for phase in WallBot.RUN_PHASES:
+            for bot in bots:
+                bot.run_phase(phase)
+        self.state['last_run'] = time.time()
+        self.state.save()
+        self.metrics.report()
+        self.metrics.reset()
+
+    def plan(self, path):
+        """Plan a run of each bot, print the plans and save them to path"""
+        plans = [bot.plan() for bot in self.bots]
+        for plan in plans:
+            print(plan.describe())
+        with open(path, 'w') as f:
+            json.dump([plan.to_json() for plan in plans], f, indent=1)
+
+    def apply(self, path):
+        """Apply the plans saved by plan to their subreddits"""
+        with open(path) as f:
+            plans = [Plan.from_json(document) for document in json.load(f)]
+        bots = {bot.name.lower(): bot for bot in self.bots}
+        for plan in plans:
+            bot = bots.get(plan.subreddit.lower())
+            if bot is None:
+                logging.warning("No bot for /r/%s, skipping its plan",
+                                plan.subreddit)
+                continue
+            bot.apply(plan)
+        self.state.save()
+
+    def daemon(self, sweep_interval=SWEEP_INTERVAL,
+               poll_interval=POLL_INTERVAL):
+        """
+        Keep running with the same session, reacting to new RIs and modmail
+        commands as they happen.
+
+        RIs are picked up from the flair edits of the moderation log rather
+        than from new submissions, since posts are flaired after the fact.
+        Permits are expired as soon as their expiry date has passed, and a
+        full run, which takes care of anything the streams may have missed,
+        happens every ``sweep_interval`` seconds.
+        """
+
+        next_sweep = time.monotonic()
+        while True:
+            # pause_after=-1 makes the streams yield None after each request
+            streams = [
+                (
+                    bot,
+                    bot.subreddit.mod.stream.log(
+                        action='editflair', pause_after=-1,
+                        skip_existing=True,
+                    ),
+                    bot.subreddit.mod.stream.modmail_conversations(
+                        pause_after=-1, skip_existing=True
+                    ),
+                )
+                for bot in self.bots
+            ]
+            try:
+                while True:
+                    if time.monotonic() >= next_sweep:
+                        for bot in self.bots:
+                            bot.allowlist.reload()
+                        self.run()
+                        next_sweep = time.monotonic() + sweep_interval
+                    for bot, flair_log, modmail in self.rotation(streams):
+                        next_expiry = bot.allowlist.next_expiry()
+                        if (next_expiry is not None
+                                and next_expiry < date.today()):
+                            bot.remove_expired_permits()
+                            bot.commit()
+                        bot.daemon_round(flair_log, modmail)
+                    time.sleep(poll_interval)
+            except (prawcore.exceptions.PrawcoreException,
+                    praw.exceptions.RedditAPIException):
+                logging.exception("Reddit request failed, restarting streams")
+                # Catch up on what happened while the streams were down
+                next_sweep = time.monotonic() + poll_interval
+                time.sleep(poll_interval)
+
+
+class StartupProbe:
+    """
+    Cheap check of whether a oneshot run has anything to do, made before
+    praw is even imported.
+
+    A run is needed when an RI listing has a submission newer than the RI
+    cursor, when a permit has expired, when PMs are waiting in the outbox,
+    when modmail was updated since the last run, or when the last run is
+    older than ``full_run_interval``. The latter bounds how late flairs
+    given to older posts are picked up, as the probe cannot see them.
+
+    Both the newest submissions and modmail are fetched with the access
+    token stored by the last run, so that the listing is the one the bot
+    sees as a moderator, removed posts included, and a run is made whenever
+    that token has expired.
+    """
+
+    URL = 'https://oauth.reddit.com/r/{}/new?limit=1&raw_json=1'
+    MODMAIL_URL = ('https://oauth.reddit.com/api/mod/conversations'
+                   '?entity={}&limit=1&sort=recent&raw_json=1')
+
+    def __init__(self, config, state, outbox, full_run_interval,
+                 tokens=None):
+        self.config = config
+        self.state = state
+        self.outbox = outbox
+        self.full_run_interval = full_run_interval
+        self.tokens = TokenStore() if tokens is None else tokens
+
+    def needs_run(self):
+        if time.time() - self.state.get('last_run', 0) >= (
+            self.full_run_interval
+        ):
+            return True
+        if self.outbox.pending():
+            return True
+        names = subreddit_names(self.config)
+        for name in names:
+            state = self.state.data if len(names) == 1 else (
+                self.state.get(name, {})
+            )
+            cursor = state.get('ri_cursor')
+            next_expiry = state.get('next_expiry')
+            if cursor is None:
+                return True
+            if (next_expiry is not None
+                    and date.fromisoformat(next_expiry) < date.today()):
+                return True
+            listing = '+'.join(ri_subreddits(self.config, name))
+            if self.newest(listing) != cursor['fullname']:
+                return True
+            modmail_updated = self.modmail_updated(name)
+            if (modmail_updated is None
+                    or modmail_updated != state.get('modmail_updated')):
+                return True
+        return False
+
+    def fetch(self, url, token=None):
+        """JSON document at url, None on error"""
+        from urllib.request import Request, urlopen
+
+        headers = {'User-Agent': USER_AGENT}
+        if token is not None:
+            headers['Authorization'] = 'bearer ' + token
+        try:
+            with urlopen(Request(url, headers=headers),
+                         timeout=PROBE_TIMEOUT) as response:
+                return json.load(response)
+        except (OSError, ValueError) as e:
+            logging.warning("Could not probe %s: %s", url, e)
+            return None
+
+    def newest(self, listing):
+        """Fullname of the newest submission of a listing, None on error"""
+        stored = self.tokens.token()
+        if stored is None:
+            return None
+        document = self.fetch(self.URL.format(listing),
+                              stored['access_token'])
+        try:
+            return document['data']['children'][0]['data']['name']
+        except (TypeError, LookupError):
+            return None
+
+    def modmail_updated(self, subreddit):
+        """Last update of the modmail of a subreddit, None if unknown"""
+        stored = self.tokens.token()
+        if stored is None:
+            return None
+        document = self.fetch(self.MODMAIL_URL.format(subreddit),
+                              stored['access_token'])
+        try:
+            return max(conv['lastUpdated']
+                       for conv in document['conversations'].values())
+        except (TypeError, LookupError, ValueError):
+            return None
 
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        '--daemon', action='store_true',
+        help="keep running and react to new RIs as they are flaired",
+    )
+    mode.add_argument(
+        '--plan', metavar='FILE',
+        help="print what a run would do without doing it, and save it to "
+        "FILE",
+    )
+    mode.add_argument(
+        '--apply', metavar='FILE',
+        help="do what was planned with --plan",
+    )
+    args = parser.parse_args()
+
     config = configparser.ConfigParser()
     config.read('settings.conf')
-    bot = WallBot(config)
-    bot.run()
+    state = BotState(config_option(config, 'bot', 'state_file', STATE_FILE))
+    outbox = Outbox(config_option(config, 'bot', 'outbox', OUTBOX_FILE))
+    tokens = TokenStore(
+        config_option(config, 'bot', 'token_file', TOKEN_FILE) or None
+    )
+    full_run_interval = int(config_option(config, 'bot', 'full_run_interval',
+                                          0))
+    if (
+        full_run_interval
+        and not (args.daemon or args.plan or args.apply)
+        and not StartupProbe(config, state, outbox, full_run_interval,
+                             tokens).needs_run()
+    ):
+        logging.info("Nothing new since the last run")
+        return
+
+    network = Network.from_config(config, state, outbox, tokens)
+    try:
+        if args.plan:
+            network.plan(args.plan)
+        elif args.apply:
+            network.apply(args.apply)
+        elif args.daemon:
+            network.daemon(
+                sweep_interval=int(config_option(
+                    config, 'bot', 'sweep_interval', SWEEP_INTERVAL
+                )),
+                poll_interval=int(config_option(
+                    config, 'bot', 'poll_interval', POLL_INTERVAL
+                )),
+            )
+        else:
+            network.run()
+    finally:
+        tokens.save(network.reddit)
 
 
 if __name__ == '__main__':
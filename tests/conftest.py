@@ -1,10 +1,15 @@
+import praw
+import prawcore
 import pytest
 import yaml
 
 from datetime import date, timedelta
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock, create_autospec, patch
 
-from hoa_bot import WallBot, WikiAllowlist
+from hoa_bot import (
+    BotState, ModeratorRoster, Outbox, RequestBudget, RunMetrics, WallBot,
+    WikiAllowlist,
+)
 
 
 def pytest_configure():
@@ -15,7 +20,7 @@ def pytest_configure():
 
 @pytest.fixture
 def gen_allowlist():
-    def f(permits=None, permallowed=None):
+    def f(permits=None, permallowed=None, factory=WikiAllowlist):
         if permits is None:
             permits = {}
         if permallowed is None:
@@ -26,13 +31,20 @@ def gen_allowlist():
             WikiAllowlist.PERMIT_KEY: permits,
             WikiAllowlist.PERMALLOWED_KEY: permallowed,
         })
+        wiki_page.revision_id = 'rev0'
 
-        allowlist = WikiAllowlist(subreddit)
+        allowlist = factory(subreddit)
         allowlist.output = None
 
-        def save_output(yml):
-            allowlist.output = yaml.safe_load(yml)
-            wiki_page.content_md = yml
+        def save_output(content, previous=None, reason=None):
+            if previous != wiki_page.revision_id:
+                raise prawcore.exceptions.Conflict(MagicMock(status_code=409))
+            allowlist.output = yaml.safe_load(content)
+            wiki_page.content_md = content
+            wiki_page.revision_id = 'rev{}'.format(wiki_page.edit.call_count)
+            wiki_page.revisions.return_value = [
+                {'id': wiki_page.revision_id, 'reason': reason},
+            ]
 
         wiki_page.edit.side_effect = save_output
         return allowlist
@@ -40,10 +52,18 @@ def gen_allowlist():
     return f
 
 
+# Mocks of their methods check their calls against the signatures of praw's
+SPEC_REDDITOR = praw.models.Redditor(MagicMock(), name='spec')
+SPEC_CONVERSATION = praw.models.ModmailConversation(MagicMock(), id='spec')
+
+
 class TestRedditor:
     def __init__(self, username):
         self.username = username
-        self.message = MagicMock()
+        self.message = create_autospec(SPEC_REDDITOR.message)
+
+    def __str__(self):
+        return self.username
 
     def __eq__(self, value):
         if self.username == value:
@@ -87,34 +107,51 @@ def gen_subreddit(gen_allowlist):
         res.contributor.return_value = [
             redditor_factory(u) for u in contributors
         ]
+        res.contributor.add.side_effect = res.contributor.return_value.append
+        res.contributor.remove.side_effect = (
+            res.contributor.return_value.remove
+        )
 
         res.posts = [
             MagicMock(
+                fullname=p.get('fullname', 't3_{}'.format(i)),
                 subject=p.get('subject'),
                 author=p.get('author'),
+                subreddit=p.get('subreddit', 'badeconomics'),
                 created_utc=p.get('created_utc'),
                 link_flair_text=p.get('link_flair_text'),
             )
-            for p in posts
+            for i, p in enumerate(posts)
         ]
         res.new.return_value = res.posts
 
         res.modmail_conversations = [
             MagicMock(
+                id=c.get('id', 'conv{}'.format(i)),
                 subject=c.get('subject'),
                 participant=c.get('participant'),
+                last_updated=c.get(
+                    'last_updated', '2021-05-01T00:{:02}:00+00:00'.format(i)
+                ),
                 messages=[
                     MagicMock(
+                        id=m.get('id', 'conv{}_{}'.format(i, j)),
                         author=m.get('author'),
                         date=m.get('date'),
                         body_markdown=m.get('body_markdown'),
                     )
-                    for m in c.get('messages', [])
-                ]
+                    for j, m in enumerate(c.get('messages', []))
+                ],
+                reply=create_autospec(SPEC_CONVERSATION.reply),
+                archive=create_autospec(SPEC_CONVERSATION.archive),
             )
-            for c in modmail
+            for i, c in enumerate(modmail)
         ]
         res.modmail.conversations.return_value = res.modmail_conversations
+        # subreddit.modmail(id) gives the conversation, as lazily as praw
+        res.modmail.side_effect = lambda id: next(
+            conv for conv in res.modmail_conversations if conv.id == id
+        )
         return res
 
     return f
@@ -155,6 +192,13 @@ def gen_bot(monkeypatch, gen_allowlist, gen_subreddit):
         )
         res.reddit = MagicMock()
         res.reddit.redditor = res.subreddit.redditor_factory
+        res.reddit.auth.limits = {}
+        res.state = BotState()
+        res.moderators = ModeratorRoster(res.subreddit, res.state)
+        res.budget = RequestBudget(res.reddit)
+        res.outbox = Outbox()
+        res.metrics = RunMetrics()
+        res.snapshot = {}
         return res
 
     return f
@@ -0,0 +1,121 @@
+import praw
+import prawcore
+import pytest
+
+from unittest.mock import MagicMock, call
+
+from hoa_bot import (
+    OUTBOX_ATTEMPTS, ActionQueue, CountingRequestor, Outbox, RunMetrics,
+)
+
+
+def gen_queue(**kwargs):
+    reddit = MagicMock()
+    reddit.auth.limits = {}
+    return ActionQueue(reddit, backoff=0, **kwargs)
+
+
+def test_steps_in_order():
+    queue = gen_queue()
+    steps = MagicMock()
+    queue.add('first', steps.add, steps.message)
+    queue.add('second', steps.remove)
+    assert queue.run() == ['first', 'second']
+    assert steps.mock_calls.index(call.add()) < steps.mock_calls.index(
+        call.message()
+    )
+    assert queue.actions == []
+
+
+def test_failed_step_stops_action():
+    queue = gen_queue()
+    add = MagicMock(side_effect=prawcore.exceptions.Forbidden(
+        MagicMock(status_code=403)
+    ))
+    message = MagicMock()
+    queue.add('grant', add, message)
+    assert queue.run() == []
+    add.assert_called_once()
+    message.assert_not_called()
+
+    message.side_effect = praw.exceptions.RedditAPIException(
+        [['USER_DOESNT_EXIST', "that user doesn't exist", 'to']]
+    )
+    queue.add('notify', message)
+    assert queue.run() == []
+
+
+def test_programming_errors_raised():
+    queue = gen_queue()
+    queue.add('notify', MagicMock(side_effect=TypeError('bad arguments')))
+    with pytest.raises(TypeError):
+        queue.run()
+
+
+def test_transient_errors_retried():
+    queue = gen_queue(retries=2)
+    error = prawcore.exceptions.ServerError(MagicMock(status_code=503))
+    flaky = MagicMock(side_effect=[error, error, None])
+    down = MagicMock(side_effect=error)
+    queue.add('flaky', flaky)
+    queue.add('down', down)
+    assert queue.run() == ['flaky']
+    assert flaky.call_count == 3
+    assert down.call_count == 3
+
+
+def test_outbox_idempotent(tmp_path):
+    path = str(tmp_path / 'outbox.sqlite')
+    outbox = Outbox(path)
+    assert outbox.enqueue('granted:user42:2021-01-01', 'user42', 'hi', 'yo')
+    assert not outbox.enqueue('granted:user42:2021-01-01', 'user42', 'hi',
+                              'yo')
+    assert outbox.enqueue('expired:user43:2020-01-01', 'user43', 'bye', 'yo')
+
+    # Survives a crash
+    outbox = Outbox(path)
+    assert [p[0] for p in outbox.pending()] == [
+        'granted:user42:2021-01-01', 'expired:user43:2020-01-01',
+    ]
+    outbox.mark_sent('granted:user42:2021-01-01')
+    assert not outbox.enqueue('granted:user42:2021-01-01', 'user42', 'hi',
+                              'yo')
+    assert [p[0] for p in outbox.pending()] == ['expired:user43:2020-01-01']
+
+    for _ in range(OUTBOX_ATTEMPTS):
+        outbox.attempt('expired:user43:2020-01-01')
+    assert outbox.pending() == []
+
+    outbox.prune(0)
+    assert outbox.enqueue('granted:user42:2021-01-01', 'user42', 'hi', 'yo')
+
+
+def test_run_metrics(tmp_path):
+    metrics = RunMetrics(str(tmp_path / 'hoa_bot.prom'))
+    session = MagicMock()
+    session.request.return_value.content = b'{"data": {}}'
+    requestor = CountingRequestor(user_agent='test agent', session=session,
+                                  metrics=metrics)
+
+    requestor.request('GET', 'https://oauth.reddit.com/api/v1/me')
+    with metrics.phase('badeconomics', 'process_modmail'):
+        requestor.request('GET', 'https://oauth.reddit.com/api/mod/conv')
+        with metrics.phase('badeconomics', 'archive_modmail_notifs'):
+            requestor.request('POST', 'https://oauth.reddit.com/api/archive')
+            requestor.request('POST', 'https://oauth.reddit.com/api/archive')
+            metrics.items(2)
+    metrics.report()
+
+    outer = metrics.phases[('badeconomics', 'process_modmail')]
+    inner = metrics.phases[('badeconomics', 'archive_modmail_notifs')]
+    assert (outer['requests'], outer['bytes'], outer['items']) == (1, 12, 0)
+    assert (inner['requests'], inner['bytes'], inner['items']) == (2, 24, 2)
+    assert (metrics.requests, metrics.bytes) == (4, 48)
+    textfile = (tmp_path / 'hoa_bot.prom').read_text()
+    assert ('hoa_bot_phase_requests{subreddit="badeconomics",'
+            'phase="archive_modmail_notifs"} 2') in textfile
+    assert 'hoa_bot_run_requests 4' in textfile
+
+    metrics.reset()
+    assert metrics.phases == {}
+    assert metrics.requests == 0
@@ -1,7 +1,9 @@
 import pytest
-from datetime import timedelta
+import yaml
+from datetime import date, timedelta
+import os
 
-from hoa_bot import PERMIT_LENGTH
+from hoa_bot import PERMIT_LENGTH, PermitTable, SqliteAllowlist, WikiAllowlist
 
 
 def test_empty_commit(gen_allowlist):
@@ -75,3 +77,247 @@ def test_add_expired_permit(gen_allowlist):
     allowlist.commit()
     assert allowlist.output is None  # No change
     assert allowlist.permits() == {}
+
+
+def test_expired(gen_allowlist):
+    old = pytest.TODAY - timedelta(days=PERMIT_LENGTH + 1)
+    allowlist = gen_allowlist({
+        'piketty': pytest.TODAY,
+        'summers': old,
+        'krugman': old - timedelta(days=1),
+        'sowell': pytest.TODAY - timedelta(days=PERMIT_LENGTH),
+    })
+    assert allowlist.next_expiry() == old - timedelta(days=1) + timedelta(
+        days=PERMIT_LENGTH
+    )
+    assert allowlist.update('summers', pytest.TODAY)  # renewed
+    assert allowlist.expired() == ['krugman']
+    assert allowlist.expired() == []
+    assert allowlist.next_expiry() == pytest.TODAY
+    allowlist.delete('sowell')
+    assert allowlist.next_expiry() == pytest.TODAY + timedelta(
+        days=PERMIT_LENGTH
+    )
+
+
+def test_commit_conflict(gen_allowlist):
+    allowlist = gen_allowlist({'piketty': pytest.TODAY})
+    wiki_page = allowlist.subreddit.wiki['zoning_whitelist']
+    assert allowlist.update('summers', pytest.TODAY)
+    allowlist.delete('piketty')
+
+    # A moderator edits the page before the bot commits
+    wiki_page.content_md = yaml.safe_dump({
+        allowlist.PERMIT_KEY: {
+            'piketty': pytest.TODAY,
+            'sowell': pytest.TODAY,
+        },
+        allowlist.PERMALLOWED_KEY: ['danny'],
+    })
+    wiki_page.revision_id = 'modedit'
+
+    allowlist.commit()
+    assert wiki_page.edit.call_count == 2
+    assert allowlist.output == {
+        allowlist.PERMIT_KEY: {
+            'summers': pytest.TODAY,
+            'sowell': pytest.TODAY,
+        },
+        allowlist.PERMALLOWED_KEY: ['danny'],
+    }
+    assert allowlist.permits() == {
+        'summers': pytest.TODAY, 'sowell': pytest.TODAY,
+    }
+
+    # Nothing to commit, nothing fetched
+    wiki_page.reset_mock()
+    allowlist.commit()
+    wiki_page.edit.assert_not_called()
+    assert allowlist.update('piketty', pytest.TODAY)
+    allowlist.commit()
+    assert wiki_page.edit.call_count == 1
+    assert allowlist.output[allowlist.PERMIT_KEY] == {
+        'piketty': pytest.TODAY,
+        'summers': pytest.TODAY,
+        'sowell': pytest.TODAY,
+    }
+
+
+def test_revision_cache(gen_allowlist, tmp_path):
+    allowlist = gen_allowlist({'piketty': pytest.TODAY}, ['danny'])
+    subreddit = allowlist.subreddit
+    wiki_page = subreddit.wiki['zoning_whitelist']
+    cache_path = str(tmp_path / 'wiki.json')
+    WikiAllowlist(subreddit, cache_path=cache_path)
+
+    # Same revision: the page content is not used
+    wiki_page.revisions.return_value = [{'id': 'rev0'}]
+    wiki_page.content_md = 'invalid: ['
+    cached = WikiAllowlist(subreddit, cache_path=cache_path)
+    wiki_page.revisions.assert_called_once_with(limit=1)
+    assert cached.permits() == {'piketty': pytest.TODAY}
+    assert list(cached.permallowed()) == ['danny']
+    assert cached.revision_id == 'rev0'
+
+    # Committing caches the revision it made
+    cached.update('summers', pytest.TODAY)
+    cached.commit()
+    assert cached.revision_id == 'rev1'
+    wiki_page.content_md = 'invalid: ['
+    reloaded = WikiAllowlist(subreddit, cache_path=cache_path)
+    assert reloaded.permits() == {
+        'piketty': pytest.TODAY,
+        'summers': pytest.TODAY,
+    }
+    assert reloaded.revision_id == 'rev1'
+
+    # Unless a moderator edited the page right after
+    wiki_page.edit.side_effect = None
+    wiki_page.revisions.return_value = [{'id': 'modedit', 'reason': ''}]
+    reloaded.update('sowell', pytest.TODAY)
+    reloaded.commit()
+    assert reloaded.revision_id is None
+    assert not os.path.exists(cache_path)
+
+
+def test_serializer_roundtrip():
+    serializer = WikiAllowlist.serializer
+    document = {
+        WikiAllowlist.PERMIT_KEY: {
+            'summers': pytest.TODAY,
+            'piketty': pytest.YESTERDAY,
+        },
+        WikiAllowlist.PERMALLOWED_KEY: ['danny'],
+    }
+    text = serializer.dump(document)
+    assert serializer.load(text) == document
+    assert text.index('piketty') < text.index('summers')
+    assert serializer.load(yaml.safe_dump(document)) == document
+
+
+def test_serializer_no_aliases():
+    document = {
+        WikiAllowlist.PERMIT_KEY: dict(PermitTable({
+            'summers': pytest.TODAY,
+            'piketty': date.fromordinal(pytest.TODAY.toordinal()),
+        }).items()),
+        WikiAllowlist.PERMALLOWED_KEY: [],
+    }
+    text = WikiAllowlist.serializer.dump(document)
+    assert '&' not in text and '*' not in text
+    assert text.count(pytest.TODAY.isoformat()) == 2
+
+
+def sqlite_factory(path):
+    def f(subreddit):
+        return SqliteAllowlist(subreddit, str(path))
+    return f
+
+
+def test_sqlite_allowlist(gen_allowlist, tmp_path):
+    old = pytest.TODAY - timedelta(days=PERMIT_LENGTH + 1)
+    factory = sqlite_factory(tmp_path / 'allowlist.sqlite')
+    allowlist = gen_allowlist(
+        {'piketty': pytest.TODAY, 'summers': old, 'danny': old},
+        ['danny'],
+        factory=factory,
+    )
+    assert allowlist.permits() == {
+        'piketty': pytest.TODAY, 'summers': old, 'danny': old,
+    }
+    assert list(allowlist.permallowed()) == ['danny']
+    assert allowlist.next_expiry() == old + timedelta(days=PERMIT_LENGTH)
+    assert allowlist.expired() == ['summers']
+
+    allowlist.delete('summers')
+    assert allowlist.update('sowell', pytest.YESTERDAY)
+    assert allowlist.output is None
+    assert allowlist['sowell'] == pytest.YESTERDAY
+    allowlist.commit()
+    assert allowlist.output == {
+        allowlist.PERMIT_KEY: {
+            'piketty': pytest.TODAY,
+            'sowell': pytest.YESTERDAY,
+            'danny': old,
+        },
+        allowlist.PERMALLOWED_KEY: ['danny'],
+    }
+    assert allowlist.expired() == []
+
+
+def test_sqlite_allowlist_unchanged_revision(gen_allowlist, tmp_path):
+    factory = sqlite_factory(tmp_path / 'allowlist.sqlite')
+    allowlist = gen_allowlist({'piketty': pytest.TODAY}, factory=factory)
+    wiki_page = allowlist.subreddit.wiki['zoning_whitelist']
+    wiki_page.revisions.return_value = [{'id': 'rev0'}]
+    wiki_page.content_md = 'invalid: ['
+    reloaded = factory(allowlist.subreddit)
+    assert reloaded.permits() == {'piketty': pytest.TODAY}
+
+
+def test_sqlite_allowlist_own_revision(gen_allowlist, tmp_path):
+    factory = sqlite_factory(tmp_path / 'allowlist.sqlite')
+    allowlist = gen_allowlist({'piketty': pytest.TODAY}, factory=factory)
+    allowlist.update('summers', pytest.TODAY)
+    allowlist.commit()
+
+    # The next run does not import the bot's own edit again
+    wiki_page = allowlist.subreddit.wiki['zoning_whitelist']
+    wiki_page.content_md = 'invalid: ['
+    reloaded = factory(allowlist.subreddit)
+    assert reloaded.revision_id == 'rev1'
+    assert reloaded.permits() == {
+        'piketty': pytest.TODAY,
+        'summers': pytest.TODAY,
+    }
+
+
+def test_sqlite_allowlist_crash_recovery(gen_allowlist, tmp_path):
+    factory = sqlite_factory(tmp_path / 'allowlist.sqlite')
+    allowlist = gen_allowlist({'piketty': pytest.TODAY}, factory=factory)
+    assert allowlist.update('summers', pytest.TODAY)
+    allowlist.delete('piketty')
+
+    # A moderator edits the page before the next run
+    wiki_page = allowlist.subreddit.wiki['zoning_whitelist']
+    wiki_page.content_md = yaml.safe_dump({
+        allowlist.PERMIT_KEY: {
+            'piketty': pytest.TODAY,
+            'sowell': pytest.TODAY,
+        },
+        allowlist.PERMALLOWED_KEY: [],
+    })
+    wiki_page.revision_id = 'modedit'
+
+    recovered = factory(allowlist.subreddit)
+    recovered.commit()
+    assert allowlist.output[allowlist.PERMIT_KEY] == {
+        'summers': pytest.TODAY,
+        'sowell': pytest.TODAY,
+    }
+    assert recovered.to_update == {}
+    assert factory(allowlist.subreddit).to_update == {}
+
+
+def test_permit_table():
+    table = PermitTable({'Piketty': pytest.TODAY, 'summers': pytest.TODAY})
+    assert 'piketty' in table
+    assert table['PIKETTY'] == pytest.TODAY
+    assert table == {'Piketty': pytest.TODAY, 'summers': pytest.TODAY}
+
+    del table['Summers']
+    table['sowell'] = pytest.YESTERDAY
+    table['piketty'] = pytest.YESTERDAY
+    assert table == {'Piketty': pytest.YESTERDAY, 'sowell': pytest.YESTERDAY}
+    assert table._names == {'piketty': 'Piketty'}
+    assert table.ordinals() == [pytest.YESTERDAY.toordinal()] * 2
+    assert 'summers' not in table
+
+
+def test_case_insensitive_allowlist(gen_allowlist):
+    allowlist = gen_allowlist({'Piketty': pytest.YESTERDAY}, ['Danny'])
+    assert 'danny' in allowlist.permallowed()
+    assert list(allowlist.permallowed()) == ['Danny']
+    assert allowlist.update('piketty', pytest.TODAY)
+    allowlist.commit()
+    assert allowlist.output[allowlist.PERMIT_KEY] == {'Piketty': pytest.TODAY}
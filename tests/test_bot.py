@@ -1,9 +1,22 @@
 import pytest
 
 from datetime import datetime, timedelta
-from unittest.mock import call
+from functools import partial
+import json
+import os
+import threading
+import time
+from unittest.mock import MagicMock, call
 
-from hoa_bot import PERMIT_LENGTH, PM_GRANTED_SUBJECT, PM_EXPIRE_SUBJECT
+import praw
+import yaml
+
+from hoa_bot import (
+    PERMIT_LENGTH, PM_GRANTED_SUBJECT, PM_EXPIRE_SUBJECT, PREFETCH_WORKERS,
+    BotState, ContributorRoster, ModeratorRoster, Network, Outbox, Plan,
+    RIRule, RunMetrics, SqliteAllowlist, StartupProbe, TokenStore, WallBot,
+    connect, subreddit_path,
+)
 
 
 def test_permallowed_granted_permits(gen_bot):
@@ -28,7 +41,7 @@ def test_grant_permits(gen_bot):
     bot.reddit.redditor('user42').message.assert_called_once()
     bot.reddit.redditor('contributor1337').message.assert_not_called()
 
-    assert (bot.reddit.redditor('user42').message.call_args[0][0]
+    assert (bot.reddit.redditor('user42').message.call_args[1]['subject']
             == PM_GRANTED_SUBJECT.format(user='user42'))
 
     assert (call(bot.reddit.redditor('user42'))
@@ -53,7 +66,8 @@ def test_remove_expired_permits(gen_bot):
     bot.reddit.redditor('oldcontributor').message.assert_called_once()
     bot.reddit.redditor('olduser').message.assert_not_called()
 
-    assert (bot.reddit.redditor('oldcontributor').message.call_args[0][0]
+    message = bot.reddit.redditor('oldcontributor').message
+    assert (message.call_args[1]['subject']
             == PM_EXPIRE_SUBJECT.format(user='oldcontributor'))
 
     assert (call(bot.reddit.redditor('contributor1337'))
@@ -350,3 +364,728 @@ def test_allow_from_ris(gen_bot):
             not in bot.subreddit.contributor.add.call_args_list)
     assert (call(bot.reddit.redditor('oldpermitgirl'))
             not in bot.subreddit.contributor.add.call_args_list)
+
+
+def test_contributor_listing_fetched_once(gen_bot):
+    bot = gen_bot(
+        permits={
+            'user42': pytest.TODAY,
+            'Contributor1337': pytest.YESTERDAY,
+            'oldcontributor': pytest.TODAY - timedelta(days=PERMIT_LENGTH + 2),
+        },
+        contributors=['contributor1337', 'oldcontributor'],
+        permallowed=['danny', 'user42'],
+    )
+    bot.run()
+    bot.subreddit.contributor.assert_called_once_with(limit=None)
+    assert sorted(
+        str(c[0][0]) for c in bot.subreddit.contributor.add.call_args_list
+    ) == ['danny', 'user42']
+    assert bot.subreddit.contributor.remove.call_args_list == [
+        call(bot.reddit.redditor('oldcontributor')),
+    ]
+    bot.reddit.redditor('Contributor1337').message.assert_not_called()
+
+
+def test_contributor_roster_probes_few_users(gen_subreddit):
+    subreddit = gen_subreddit(contributors=[
+        'user{}'.format(i) for i in range(250)
+    ])
+    state = BotState()
+
+    # The size of the listing is not known before a first snapshot
+    roster = ContributorRoster(subreddit, state)
+    assert 'User3' in roster
+    subreddit.contributor.assert_called_once_with(limit=None)
+    assert state['contributor_count'] == 250
+
+    # Three pages now, so up to three users are probed
+    subreddit.contributor.reset_mock()
+    subreddit.contributor.side_effect = lambda redditor: [
+        u for u in subreddit.contributor.return_value if str(u) == redditor
+    ]
+    roster = ContributorRoster(subreddit, state)
+    assert roster.missing(['user1', 'danny', 'USER2']) == ['danny']
+    assert subreddit.contributor.call_args_list == [
+        call(redditor='danny'), call(redditor='user1'), call(redditor='user2'),
+    ]
+    roster.add('danny')
+    assert 'danny' in roster
+    assert subreddit.contributor.call_count == 3
+    assert state['contributor_count'] == 251
+
+    # But more users than pages take a snapshot
+    subreddit.contributor.side_effect = None
+    roster = ContributorRoster(subreddit, state)
+    assert roster.missing(['a', 'b', 'c', 'user4']) == ['a', 'b', 'c']
+    assert subreddit.contributor.call_args == call(limit=None)
+
+
+def test_run_with_sqlite_allowlist(gen_bot, gen_allowlist, tmp_path):
+    bot = gen_bot(contributors=['olduser'])
+    bot.allowlist = gen_allowlist(
+        permits={
+            'user42': pytest.TODAY,
+            'olduser': pytest.TODAY - timedelta(days=PERMIT_LENGTH + 1),
+        },
+        factory=lambda subreddit: SqliteAllowlist(
+            subreddit, str(tmp_path / 'allowlist.sqlite')
+        ),
+    )
+    bot.run()
+    assert bot.allowlist.permits() == {'user42': pytest.TODAY}
+    assert bot.allowlist.output[bot.allowlist.PERMIT_KEY] == {
+        'user42': pytest.TODAY,
+    }
+    bot.subreddit.contributor.add.assert_called_once_with(
+        bot.reddit.redditor('user42')
+    )
+    bot.subreddit.contributor.remove.assert_called_once_with(
+        bot.reddit.redditor('olduser')
+    )
+
+
+def test_moderators_cached_between_runs(gen_bot, tmp_path):
+    def allow_conv(participant):
+        return {
+            'subject': 'permit pls',
+            'participant': participant,
+            'messages': [
+                {
+                    'author': 'Gorby',
+                    'body_markdown': "!allow",
+                    'date': datetime.now().isoformat(),
+                },
+            ],
+        }
+
+    bot = gen_bot(
+        modmail=[allow_conv('user42'), allow_conv('user43')],
+        moderators=['gorby'],
+    )
+    bot.state = BotState(str(tmp_path / 'state.json'))
+    bot.moderators = ModeratorRoster(bot.subreddit, bot.state)
+    bot.run()
+    assert bot.subreddit.moderator.call_count == 1
+    assert set(bot.allowlist.permits()) == {'user42', 'user43'}
+
+    state = BotState(str(tmp_path / 'state.json'))
+    moderators = ModeratorRoster(bot.subreddit, state)
+    assert 'GORBY' in moderators
+    assert bot.subreddit.moderator.call_count == 1
+
+    expired = ModeratorRoster(bot.subreddit, state, ttl=0)
+    assert 'user42' not in expired
+    assert bot.subreddit.moderator.call_count == 2
+
+
+def test_modmail_fetched_once(gen_bot):
+    bot = gen_bot(modmail=[
+        {
+            'subject': 'you are an approved user',
+            'participant': 'testbot',
+            'messages': [],
+        },
+    ])
+    handled = []
+
+    def count_conversations(conversations):
+        handled.append(len(conversations))
+
+    bot.count_conversations = count_conversations
+    bot.MODMAIL_HANDLERS = bot.MODMAIL_HANDLERS + ('count_conversations',)
+    bot.run()
+    bot.subreddit.modmail.conversations.assert_called_once()
+    bot.subreddit.modmail_conversations[0].archive.assert_called()
+    assert handled == [1]
+
+
+def test_allow_from_ris_incremental(gen_bot):
+    def post(fullname, author, days_ago=0, flair=None):
+        return {
+            'fullname': fullname,
+            'author': author,
+            'created_utc': datetime.timestamp(
+                datetime.now() - timedelta(days=days_ago)
+            ),
+            'link_flair_text': flair,
+        }
+
+    bot = gen_bot(posts=[
+        post('t3_c', 'user42', flair='Sufficient'),
+        post('t3_b', 'unflaired'),
+        post('t3_a', 'stale', days_ago=30),
+    ])
+    bot.run()
+    assert bot.state['ri_cursor']['fullname'] == 't3_c'
+    assert list(bot.state['ri_pending']) == ['t3_b']
+    bot.subreddit.new.assert_called_once_with(limit=50)
+
+    flaired = bot.subreddit.posts[1]
+    flaired.link_flair_text = 'Sufficient'
+    bot.reddit.info.return_value = [flaired]
+    newer = gen_bot(posts=[post('t3_d', 'user43', flair='Sufficient')])
+    bot.subreddit.new.return_value = (newer.subreddit.posts
+                                      + bot.subreddit.posts)
+    bot.allowlist.update = MagicMock(wraps=bot.allowlist.update)
+    bot.run()
+    bot.subreddit.new.assert_called_with(limit=None)
+    bot.reddit.info.assert_called_once_with(fullnames=['t3_b'])
+    assert [c[0][0] for c in bot.allowlist.update.call_args_list] == [
+        'user43', 'unflaired',
+    ]
+    assert bot.state['ri_cursor']['fullname'] == 't3_d'
+    assert bot.state['ri_pending'] == {}
+
+
+def test_prefetch_reads_concurrently(gen_bot):
+    bot = gen_bot(posts=[{
+        'fullname': 't3_a',
+        'author': 'user42',
+        'created_utc': datetime.timestamp(datetime.now()),
+        'link_flair_text': 'Sufficient',
+    }])
+    # Each of these reads waits for the others, so they only all get through
+    # when made at the same time
+    barrier = threading.Barrier(3, timeout=5)
+
+    def wait(value, *args, **kwargs):
+        barrier.wait()
+        return value
+
+    for mock in (bot.subreddit.new, bot.subreddit.modmail.conversations,
+                 bot.subreddit.moderator):
+        mock.side_effect = partial(wait, mock.return_value)
+
+    bot.run()
+    bot.subreddit.new.assert_called_once()
+    bot.subreddit.modmail.conversations.assert_called_once()
+    bot.subreddit.moderator.assert_called_once()
+    assert bot.state['ri_cursor']['fullname'] == 't3_a'
+    assert bot.snapshot == {}
+
+
+def test_allow_from_modmail_only_new_messages(gen_bot):
+    bot = gen_bot(
+        modmail=[
+            {
+                'subject': 'hi can i get permit',
+                'participant': 'user42',
+                'messages': [
+                    {
+                        'author': 'gorby',
+                        'body_markdown': "sure !allow :-)",
+                        'date': (
+                            datetime.now() - timedelta(days=1)
+                        ).isoformat(),
+                    },
+                ],
+            },
+        ],
+        moderators=['gorby'],
+    )
+    conv = bot.subreddit.modmail_conversations[0]
+    bot.run()
+    conv.reply.assert_called_once()
+    assert bot.state['modmail_seen'] == {'conv0': 'conv0_0'}
+
+    # The permit is gone (e.g. revoked by hand), the old command is ignored
+    bot.allowlist.delete('user42')
+    conv.messages.append(MagicMock(
+        id='conv0_1', author='user42', body_markdown="thx",
+    ))
+    bot.run()
+    conv.reply.assert_called_once()
+    assert 'user42' not in bot.allowlist.permits()
+    assert bot.state['modmail_seen'] == {'conv0': 'conv0_1'}
+
+
+def test_daemon_round(gen_bot):
+    bot = gen_bot(moderators=['gorby'])
+    bot.contributors = ContributorRoster(bot.subreddit)
+    flaired = MagicMock(
+        fullname='t3_a',
+        author='user42',
+        subreddit='badeconomics',
+        created_utc=datetime.timestamp(datetime.now()),
+        link_flair_text='Sufficient',
+    )
+    bot.reddit.info.return_value = [flaired]
+    flair_log = iter([
+        MagicMock(target_fullname='t3_a'),
+        MagicMock(target_fullname='t1_b'),  # comment flair
+        None,
+        MagicMock(target_fullname='t3_c'),
+    ])
+    conv = MagicMock(
+        id='conv0',
+        participant='user43',
+        messages=[MagicMock(
+            id='conv0_0',
+            author='gorby',
+            body_markdown='!allow',
+            date=datetime.now().isoformat(),
+        )],
+    )
+    modmail = iter([conv, None])
+    bot.subreddit.modmail_conversations.append(conv)
+
+    bot.daemon_round(flair_log, modmail)
+    bot.reddit.info.assert_called_once_with(fullnames=['t3_a'])
+    conv.reply.assert_called_once()
+    assert bot.allowlist.output[bot.allowlist.PERMIT_KEY] == {
+        'user42': pytest.TODAY,
+        'user43': pytest.TODAY,
+    }
+    bot.reddit.redditor('user42').message.assert_called_once()
+    bot.reddit.redditor('user43').message.assert_called_once()
+    assert next(flair_log).target_fullname == 't3_c'
+
+
+def test_daemon_survives_api_errors(monkeypatch):
+    class Stop(Exception):
+        pass
+
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 2:
+            raise Stop
+
+    monkeypatch.setattr(time, 'sleep', sleep)
+    bot = MagicMock()
+    bot.allowlist.next_expiry.return_value = None
+    network = Network([bot], BotState(), RunMetrics())
+    network.run = MagicMock(side_effect=praw.exceptions.RedditAPIException(
+        [['SUBREDDIT_NOEXIST', 'no such subreddit', None]]
+    ))
+    with pytest.raises(Stop):
+        network.daemon(sweep_interval=3600, poll_interval=60)
+    network.run.assert_called_once()
+    # The streams were started again after the error
+    assert bot.subreddit.mod.stream.log.call_count == 2
+
+
+def test_low_budget_defers_notifications(gen_bot):
+    bot = gen_bot(
+        permits={'user42': pytest.TODAY, 'user43': pytest.TODAY},
+        modmail=[
+            {'subject': 'you are an approved user', 'messages': []},
+            {'subject': 'you are an approved user', 'messages': []},
+        ],
+    )
+    bot.reddit.auth.limits = {'remaining': bot.budget.reserve + 1}
+    bot.run()
+    assert len(bot.subreddit.contributor.add.call_args_list) == 2
+    bot.subreddit.modmail_conversations[0].archive.assert_not_called()
+    bot.subreddit.modmail_conversations[1].archive.assert_not_called()
+    assert len(bot.outbox.pending()) == 1
+    messaged = [u for u in ('user42', 'user43')
+                if bot.reddit.redditor(u).message.called]
+    assert len(messaged) == 1
+
+    bot.reddit.auth.limits = {'remaining': 100}
+    bot.run()
+    bot.subreddit.modmail_conversations[0].archive.assert_called_once()
+    bot.subreddit.modmail_conversations[1].archive.assert_called_once()
+    assert bot.outbox.pending() == []
+    bot.reddit.redditor('user42').message.assert_called_once()
+    bot.reddit.redditor('user43').message.assert_called_once()
+
+
+def test_run_phases_order(gen_bot):
+    bot = gen_bot(
+        permits={'user42': pytest.TODAY},
+        modmail=[{'subject': 'you are an approved user', 'messages': []}],
+    )
+    calls = []
+    bot.allowlist.commit = MagicMock(side_effect=lambda: calls.append('wiki'))
+    bot.subreddit.contributor.add.side_effect = (
+        lambda user: calls.append('add')
+    )
+    bot.subreddit.modmail_conversations[0].archive.side_effect = (
+        lambda: calls.append('archive')
+    )
+    bot.reddit.redditor('user42').message.side_effect = (
+        lambda *args, **kwargs: calls.append('message')
+    )
+    bot.run()
+    assert calls == ['wiki', 'add', 'message', 'archive']
+    assert bot.snapshot == {}
+
+
+def test_notifications_not_duplicated(gen_bot):
+    bot = gen_bot(permits={'user42': pytest.TODAY})
+    bot.contributors = ContributorRoster(bot.subreddit)
+    bot.grant_permits()
+    # Crash before the commit, and the listing does not show the addition
+    bot.subreddit.contributor.return_value.clear()
+    bot.run()
+    assert len(bot.subreddit.contributor.add.call_args_list) == 2
+    bot.reddit.redditor('user42').message.assert_called_once()
+
+
+def test_per_subreddit_settings(tmp_path):
+    reddit = MagicMock()
+    wiki_page = reddit.subreddit.return_value.wiki['econ_permits']
+    wiki_page.content_md = yaml.safe_dump({
+        'contributors': {
+            'user42': pytest.TODAY,
+            'user44': pytest.TODAY - timedelta(days=31),
+        },
+        'whitelist': [],
+    })
+    wiki_page.revision_id = 'rev0'
+    config = {
+        'bot': {
+            'ri_flair': 'Sufficient',
+            'wiki_cache': str(tmp_path / '{subreddit}.json'),
+        },
+        'subreddit:econ': {
+            'ri_flair': 'Quality RI',
+            'wiki_page': 'econ_permits',
+            'permit_length': '30',
+        },
+    }
+    bot = WallBot(config, 'econ', reddit=reddit, state=BotState(),
+                  outbox=Outbox())
+    reddit.subreddit.assert_called_with('econ')
+    assert bot.ri_flair == 'Quality RI'
+    assert bot.permit_length == 30
+    assert bot.allowlist.page == 'econ_permits'
+    assert bot.allowlist.cache_path == str(tmp_path / 'econ.json')
+
+    assert not bot.allowlist.update('user43',
+                                    pytest.TODAY - timedelta(days=31))
+    assert bot.allowlist.expired() == ['user44']
+
+    submission = MagicMock(
+        author='user45',
+        subreddit='econ',
+        link_flair_text='Sufficient',
+        created_utc=datetime.now().timestamp(),
+    )
+    bot.allow_from_submission(submission)
+    assert 'user45' not in bot.allowlist.to_update
+    submission.link_flair_text = 'Quality RI'
+    bot.allow_from_submission(submission)
+    assert 'user45' in bot.allowlist.to_update
+
+
+def test_subreddit_paths():
+    config = {
+        'bot': {'wiki_cache': 'wiki.json', 'allowlist_db': 'permits.sqlite'},
+    }
+    assert subreddit_path(config, 'econ', 'wiki_cache') == 'wiki.json'
+
+    config['subreddit:econ'] = {}
+    config['subreddit:askecon'] = {'allowlist_db': 'askecon.sqlite'}
+    assert subreddit_path(config, 'econ', 'wiki_cache') == 'wiki_econ.json'
+    assert (subreddit_path(config, 'askecon', 'wiki_cache')
+            == 'wiki_askecon.json')
+    assert (subreddit_path(config, 'econ', 'allowlist_db')
+            == 'permits_econ.sqlite')
+    assert (subreddit_path(config, 'askecon', 'allowlist_db')
+            == 'askecon.sqlite')
+
+    config['bot']['wiki_cache'] = 'cache/{subreddit}.json'
+    assert (subreddit_path(config, 'econ', 'wiki_cache')
+            == 'cache/econ.json')
+    assert subreddit_path(config, 'econ', 'metrics_file', '') == ''
+
+
+def test_scoped_state(tmp_path):
+    state = BotState(str(tmp_path / 'state.json'))
+    state.scope('a')['ri_cursor'] = 'x'
+    state.scope('b').save()
+    assert BotState(str(tmp_path / 'state.json')).get('a') == {
+        'ri_cursor': 'x'
+    }
+
+
+def test_network_runs_phase_by_phase():
+    calls = []
+    bots = []
+    for name in ('a', 'b'):
+        bot = MagicMock()
+        bot.run_phase.side_effect = partial(
+            lambda name, phase: calls.append((name, phase)), name
+        )
+        bots.append(bot)
+    network = Network(bots, BotState(), RunMetrics())
+
+    network.run()
+    assert calls == [
+        (name, phase)
+        for phase in WallBot.RUN_PHASES
+        for name in ('a', 'b')
+    ]
+
+    # The other subreddit goes first on the next run
+    calls.clear()
+    network.run()
+    first = WallBot.RUN_PHASES[0]
+    assert calls[:2] == [('b', first), ('a', first)]
+
+
+def test_snapshots_not_shared(tmp_path):
+    subreddits = {}
+
+    def subreddit(name):
+        if name not in subreddits:
+            sub = subreddits[name] = MagicMock()
+            sub.wiki['zoning_whitelist'].content_md = yaml.safe_dump({
+                'contributors': {}, 'whitelist': [],
+            })
+            sub.modmail.conversations.return_value = []
+        return subreddits[name]
+
+    reddit = MagicMock()
+    reddit.subreddit.side_effect = subreddit
+    config = {'bot': {'wiki_cache': str(tmp_path / '{subreddit}.json')}}
+    bots = [WallBot(config, name, reddit=reddit, state=BotState(),
+                    outbox=Outbox()) for name in ('a', 'b')]
+    for bot in bots:
+        bot.process_modmail()
+    subreddits['a'].modmail.conversations.assert_called_once()
+    subreddits['b'].modmail.conversations.assert_called_once()
+
+
+def test_allow_from_network_ris(gen_bot):
+    now = datetime.timestamp(datetime.now())
+    posts = [
+        MagicMock(fullname='t3_{}'.format(i), author='user{}'.format(i),
+                  subreddit=subreddit, created_utc=now - i,
+                  link_flair_text=flair, score=score)
+        for i, (subreddit, flair, score) in enumerate([
+            ('badeconomics', 'Sufficient', 1),
+            ('AskEconomics', None, 12),
+            ('AskEconomics', None, 8),
+            ('economics', 'Sufficient', 50),
+            ('badeconomics', None, 1),
+        ])
+    ]
+    bot = gen_bot()
+    bot.reddit.subreddit.return_value.new.return_value = posts
+    bot.ri_rules = {
+        'badeconomics': RIRule(),
+        'askeconomics': RIRule(flair=None, min_score=10),
+    }
+    bot.allow_from_RIs()
+    bot.reddit.subreddit.assert_called_once_with('badeconomics+askeconomics')
+    bot.subreddit.new.assert_not_called()
+    assert set(bot.allowlist.to_update) == {'user0', 'user1'}
+    assert set(bot.state['ri_pending']) == {'t3_2', 't3_4'}
+
+
+def test_ri_rules_from_config():
+    config = {
+        'ri:AskEconomics': {'flair': '', 'min_score': '10'},
+        'ri:economics': {'flair': 'Quality'},
+    }
+    rule = RIRule.from_config(config, 'AskEconomics')
+    assert (rule.flair, rule.min_score) == (None, 10)
+    rule = RIRule.from_config(config, 'economics')
+    assert (rule.flair, rule.min_score) == ('Quality', None)
+    rule = RIRule.from_config(config, 'badeconomics', 'Sufficient')
+    assert (rule.flair, rule.min_score) == ('Sufficient', None)
+
+
+def test_plan_then_apply(gen_bot):
+    def gen():
+        return gen_bot(
+            permits={
+                'user42': pytest.TODAY,
+                'olduser': pytest.TODAY - timedelta(days=PERMIT_LENGTH + 1),
+            },
+            contributors=['olduser'],
+            modmail=[{'subject': 'you are an approved user'}],
+        )
+
+    bot = gen()
+    plan = bot.plan()
+    bot.subreddit.contributor.add.assert_not_called()
+    bot.subreddit.contributor.remove.assert_not_called()
+    bot.subreddit.modmail_conversations[0].archive.assert_not_called()
+    bot.allowlist.subreddit.wiki['zoning_whitelist'].edit.assert_not_called()
+    assert bot.outbox.pending() == []
+    assert plan.expired == {
+        'olduser': (pytest.TODAY - timedelta(days=PERMIT_LENGTH + 1))
+        .isoformat()
+    }
+    assert "-  olduser: " in plan.wiki_diff
+    described = plan.describe()
+    assert "grant /u/user42 a permit" in described
+    assert "remove /u/olduser's expired permit" in described
+    assert "archive modmail notification conv0" in described
+
+    bot = gen()
+    bot.apply(Plan.from_json(json.loads(json.dumps(plan.to_json()))))
+    assert (call(bot.reddit.redditor('user42'))
+            in bot.subreddit.contributor.add.call_args_list)
+    bot.subreddit.contributor.remove.assert_called_once_with(
+        bot.reddit.redditor('olduser')
+    )
+    bot.subreddit.modmail_conversations[0].archive.assert_called_once()
+    assert 'olduser' not in bot.allowlist.output['contributors']
+    assert bot.reddit.redditor('user42').message.call_args[1]['subject'] == (
+        PM_GRANTED_SUBJECT.format(user='user42')
+    )
+    assert bot.reddit.redditor('olduser').message.call_args[1]['subject'] == (
+        PM_EXPIRE_SUBJECT
+    )
+
+
+def test_apply_skips_renewed_permits(gen_bot):
+    def gen(olduser_start):
+        return gen_bot(
+            permits={'olduser': olduser_start},
+            contributors=['olduser'],
+        )
+
+    plan = gen(pytest.TODAY - timedelta(days=PERMIT_LENGTH + 1)).plan()
+    assert "remove /u/olduser's expired permit" in plan.describe()
+
+    # Renewed between the plan and its application
+    bot = gen(pytest.TODAY)
+    bot.apply(Plan.from_json(json.loads(json.dumps(plan.to_json()))))
+    bot.subreddit.contributor.remove.assert_not_called()
+    bot.reddit.redditor('olduser').message.assert_not_called()
+    assert bot.allowlist.permits() == {'olduser': pytest.TODAY}
+
+
+def test_apply_rejects_unknown_steps(gen_bot):
+    bot = gen_bot()
+    plan = Plan('badeconomics', actions=[
+        {'description': 'steal', 'steps': [['commit', 'now']]},
+    ])
+    with pytest.raises(ValueError):
+        bot.apply(plan)
+
+
+def test_startup_probe(monkeypatch):
+    state = BotState()
+    outbox = Outbox()
+    config = {'bot': {'ri_subreddits': 'badeconomics, AskEconomics'}}
+    probe = StartupProbe(config, state, outbox, full_run_interval=3600)
+    probed = []
+
+    def newest(listing):
+        probed.append(listing)
+        return 't3_b'
+
+    monkeypatch.setattr(probe, 'newest', newest)
+    monkeypatch.setattr(probe, 'modmail_updated', {
+        'badeconomics': '2021-05-01T00:00:00+00:00',
+    }.get)
+    assert probe.needs_run()  # never ran
+
+    state['last_run'] = datetime.now().timestamp()
+    state['ri_cursor'] = {'fullname': 't3_b', 'created_utc': 0}
+    state['next_expiry'] = pytest.TODAY.isoformat()
+    state['modmail_updated'] = '2021-05-01T00:00:00+00:00'
+    assert not probe.needs_run()
+    assert probed == ['badeconomics+AskEconomics']
+
+    state['modmail_updated'] = '2021-04-01T00:00:00+00:00'
+    assert probe.needs_run()  # new modmail
+    state['modmail_updated'] = '2021-05-01T00:00:00+00:00'
+
+    state['ri_cursor']['fullname'] = 't3_a'
+    assert probe.needs_run()  # new submission
+    state['ri_cursor']['fullname'] = 't3_b'
+
+    state['next_expiry'] = pytest.YESTERDAY.isoformat()
+    assert probe.needs_run()  # expired permit
+    state['next_expiry'] = None
+
+    outbox.enqueue('granted:user42', 'user42', 'subject', 'text')
+    assert probe.needs_run()  # PMs to send
+    outbox.mark_sent('granted:user42')
+    assert not probe.needs_run()
+
+    state['last_run'] -= 3600
+    assert probe.needs_run()  # periodic full run
+
+
+def test_startup_probe_uses_stored_token(monkeypatch):
+    tokens = MagicMock()
+    tokens.token.return_value = None
+    probe = StartupProbe({}, BotState(), Outbox(), full_run_interval=3600,
+                         tokens=tokens)
+    fetched = []
+
+    def fetch(url, token=None):
+        fetched.append((url, token))
+        return {'data': {'children': [{'data': {'name': 't3_b'}}]}}
+
+    monkeypatch.setattr(probe, 'fetch', fetch)
+    assert probe.newest('badeconomics') is None
+    assert fetched == []
+
+    tokens.token.return_value = {'access_token': 'abc'}
+    assert probe.newest('badeconomics') == 't3_b'
+    assert fetched == [(
+        'https://oauth.reddit.com/r/badeconomics/new?limit=1&raw_json=1',
+        'abc',
+    )]
+
+
+def test_token_store(tmp_path):
+    config = {
+        'reddit': {
+            'client_id': 'ADJFHKDSFHS',
+            'client_secret': '8932847bdsfkdhs',
+            'username': 'abc123',
+            'password': 'hunter2',
+        },
+        'bot': {'action_workers': '16'},
+    }
+    tokens = TokenStore(str(tmp_path / 'token.json'))
+    reddit = connect(config, RunMetrics(), tokens)
+    authorizer = reddit._core._authorizer
+    assert not authorizer.is_valid()
+    tokens.save(reddit)  # not logged in yet
+    assert tokens.token() is None
+
+    authorizer.access_token = 'token'
+    authorizer.scopes = {'*'}
+    authorizer._expiration_timestamp_ns = time.monotonic_ns() + 3600 * 10**9
+    authorizer._expiration_timestamp = time.time() + 3600
+    tokens.save(reddit)
+    assert os.stat(tmp_path / 'token.json').st_mode & 0o777 == 0o600
+
+    reddit = connect(config, RunMetrics(), tokens)
+    assert reddit._core._authorizer.is_valid()
+    assert reddit._core._authorizer.access_token == 'token'
+    session = reddit._core.requestor.requestor._http
+    assert session.get_adapter('https://oauth.reddit.com')._pool_maxsize == 16
+
+    # Never fewer connections than the reads of a prefetch
+    config['bot'] = {'action_workers': '2'}
+    session = connect(config, RunMetrics())._core.requestor.requestor._http
+    assert (session.get_adapter('https://oauth.reddit.com')._pool_maxsize
+            == PREFETCH_WORKERS)
+
+
+def test_redditors_only_for_changes(gen_bot):
+    bot = gen_bot(
+        permits={
+            'User1': pytest.TODAY,
+            'user2': pytest.YESTERDAY,
+            'user3': pytest.TODAY,
+            'olduser': pytest.TODAY - timedelta(days=PERMIT_LENGTH + 1),
+        },
+        permallowed=['danny', 'USER2'],
+        contributors=['user1', 'user2', 'olduser', 'modadded'],
+    )
+    factory = bot.subreddit.redditor_factory
+    assert bot.subreddit.contributor.return_value  # listing built
+    before = set(factory.redditors)
+    bot.contributors = ContributorRoster(bot.subreddit)
+    bot.remove_expired_permits()
+    bot.grant_permits()
+    assert set(factory.redditors) - before == {'user3', 'danny'}
+    assert bot.contributors.missing(['USER1', 'user4', 'User4']) == ['User4']
+    bot.subreddit.contributor.remove.assert_called_once()